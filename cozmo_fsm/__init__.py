@@ -11,6 +11,7 @@ from .trace import tracefsm
 from .particle import *
 from .particle_viewer import ParticleViewer
 from .path_planner import PathPlanner
+from .path_validator import PathValidator, ValidatePath
 from .cozmo_kin import *
 from .rrt import *
 from .path_viewer import PathViewer
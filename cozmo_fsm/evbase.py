@@ -7,6 +7,9 @@
 """
 
 import functools
+import json
+import time
+from collections import deque
 from multiprocessing import Queue
 
 import cozmo
@@ -15,12 +18,19 @@ from .trace import TRACE
 
 #________________ Event base class ________________
 
+# Event priorities: pending events are delivered in priority order,
+# and in the order they were posted within a priority.
+HIGH_PRIORITY = 0
+NORMAL_PRIORITY = 1
+LOW_PRIORITY = 2
+
 class Event:
     """Base class for all events."""
     def __init__(self, source=None):
         self.source = source
 
     cozmo_evt_type = None
+    priority = NORMAL_PRIORITY
 
     def generator(self,erouter,cozmo_evt): pass
 
@@ -31,6 +41,111 @@ class Event:
             src_string = repr(self.source)
         return '<%s from %s>' % (self.__class__.__name__, src_string)
 
+#________________ Event Metrics ________________
+
+class EventMetrics:
+    """Optional counters and timings for the event router; see
+    EventRouter.enable_metrics.  Per event class: posts, fan-out (the
+    number of listeners an event went to), and latency from post() to
+    the start of each handler.  Per listener: handler and poll() times."""
+    def __init__(self):
+        self.start_time = time.time()
+        self.posts = dict()     # class name -> [posts, total fan-out, max fan-out]
+        self.latency = dict()   # class name -> [calls, total secs, max secs]
+        self.listeners = dict() # listener name -> [calls, total secs, max secs]
+        self.drains = [0, 0, 0] # [drains, total handlers run, max handlers run]
+
+    def __repr__(self):
+        return '<EventMetrics: %d event classes, %d listeners, %.1f seconds>' % \
+               (len(self.posts), len(self.listeners), time.time() - self.start_time)
+
+    @staticmethod
+    def accumulate(table, key, value):
+        entry = table.get(key)
+        if entry is None:
+            table[key] = [1, value, value]
+        else:
+            entry[0] += 1
+            entry[1] += value
+            if value > entry[2]:
+                entry[2] = value
+
+    def record_post(self, event, fanout):
+        self.accumulate(self.posts, type(event).__name__, fanout)
+
+    def record_drain(self, count):
+        self.drains[0] += 1
+        self.drains[1] += count
+        self.drains[2] = max(self.drains[2], count)
+
+    def record_listener(self, listener, seconds, what='handler'):
+        name = '%s %s' % (listener, what)
+        self.accumulate(self.listeners, name, seconds)
+
+    def call_handler(self, handler, event, post_time):
+        "Run a handler scheduled by EventRouter.post, timing it."
+        start_time = time.time()
+        self.accumulate(self.latency, type(event).__name__, start_time - post_time)
+        try:
+            handler(event)
+        finally:
+            self.record_listener(handler.__self__, time.time() - start_time)
+
+    def summary(self):
+        "Everything recorded so far, as a dict that can be saved as JSON.  Times are in ms."
+        seconds = max(time.time() - self.start_time, 1e-6)
+        events = dict()
+        for (name, (posts, total_fanout, max_fanout)) in self.posts.items():
+            entry = dict(posts = posts,
+                         per_second = posts / seconds,
+                         mean_fanout = total_fanout / posts,
+                         max_fanout = max_fanout)
+            if name in self.latency:
+                (calls, total, longest) = self.latency[name]
+                entry.update(mean_latency_ms = total / calls * 1000,
+                             max_latency_ms = longest * 1000)
+            events[name] = entry
+        listeners = dict()
+        for (name, (calls, total, longest)) in self.listeners.items():
+            listeners[name] = dict(calls = calls,
+                                   total_ms = total * 1000,
+                                   mean_ms = total / calls * 1000,
+                                   max_ms = longest * 1000)
+        (drains, handlers_run, max_run) = self.drains
+        drain_summary = dict(drains = drains,
+                             mean_handlers = handlers_run / drains if drains else 0,
+                             max_handlers = max_run)
+        return dict(seconds=seconds, events=events, listeners=listeners, drains=drain_summary)
+
+    def show(self, max_listeners=20):
+        summary = self.summary()
+        print('Event metrics over %.1f seconds:' % summary['seconds'])
+        print('%-28s %8s %8s %8s %8s %10s %10s' %
+              ('event', 'posts', 'per sec', 'fanout', 'max', 'latency ms', 'max ms'))
+        for (name, e) in sorted(summary['events'].items(), key=lambda item: -item[1]['posts']):
+            print('%-28s %8d %8.1f %8.2f %8d %10.2f %10.2f' %
+                  (name, e['posts'], e['per_second'], e['mean_fanout'], e['max_fanout'],
+                   e.get('mean_latency_ms', 0), e.get('max_latency_ms', 0)))
+        drains = summary['drains']
+        print('%d dispatch queue drains, %.1f handlers per drain, at most %d' %
+              (drains['drains'], drains['mean_handlers'], drains['max_handlers']))
+        print()
+        print('%-44s %8s %10s %10s %10s' % ('listener', 'calls', 'total ms', 'mean ms', 'max ms'))
+        listeners = sorted(summary['listeners'].items(), key=lambda item: -item[1]['total_ms'])
+        for (name, l) in listeners[:max_listeners]:
+            print('%-44s %8d %10.1f %10.3f %10.3f' %
+                  (name[:44], l['calls'], l['total_ms'], l['mean_ms'], l['max_ms']))
+        if len(listeners) > max_listeners:
+            print('... and %d more listeners' % (len(listeners) - max_listeners))
+
+    def dump_json(self, filename=None):
+        "Write the summary to filename, or return it as a JSON string."
+        text = json.dumps(self.summary(), indent=2, sort_keys=True)
+        if filename is None:
+            return text
+        with open(filename, 'w') as f:
+            f.write(text)
+
 #________________ Event Router ________________
 
 class EventRouter:
@@ -42,24 +157,64 @@ class EventRouter:
         self.listener_registry = dict()
         # wildcard registry: true if listener is a wildcard (should run last)
         self.wildcard_registry = dict()
+        # dispatch_cache: event_class -> source -> tuple of handlers, in
+        # calling order; built by _get_listeners and dropped whenever any
+        # listener is added or removed, since a handler's wildcard flag
+        # applies to every event class it listens for
+        self.dispatch_cache = dict()
         # event generator objects
         self.event_generators = dict()
-        # running processes
-        self.processes = dict()  # id -> node
+        # running processes and pool jobs, by job id.  Job ids are never
+        # reused, so a reply from a job that is no longer current is dropped.
+        self.processes = dict()  # job id -> node
+        self.next_job_id = 1
         self.interprocess_queue = Queue()
+        # how we learn of events from processes; see watch_processes
+        self.process_reader_fd = None
+        self.process_poll_handle = None
+        self.metrics = None  # an EventMetrics when enabled
+        # dispatch_queues: one per priority, of (handler, event, post_time,
+        # source) entries, where source is set only in the event's last
+        # entry; see post and drain
+        # queued_sources: source -> [lowest priority (i.e., highest
+        # number) of its queued events, number of events queued]
+        self.dispatch_queues = tuple(deque() for priority in
+                                     range(HIGH_PRIORITY, LOW_PRIORITY+1))
+        self.queued_sources = dict()
+        self.drain_handle = None  # the scheduled drain callback, if any
+        self.draining = False
+        self.drain_batch = None   # the queues a running drain is working through
+
+    def enable_metrics(self):
+        "Start recording event metrics, discarding any recorded before."
+        self.metrics = EventMetrics()
+        return self.metrics
+
+    def disable_metrics(self):
+        self.metrics = None
 
     def start(self):
         self.clear()
-        self.poll_processes()
+        self.watch_processes()
 
     def clear(self):
         self.dispatch_table.clear()
         self.listener_registry.clear()
         self.wildcard_registry.clear()
+        self.dispatch_cache.clear()
+        for queue in self.dispatch_queues + (self.drain_batch or ()):
+            queue.clear()
+        self.queued_sources.clear()
+        if self.drain_handle:
+            self.drain_handle.cancel()
+            self.drain_handle = None
         self.event_generators.clear()
         self.processes.clear()
+        watching = self.unwatch_processes()
         self.interprocess_queue.close()
         self.interprocess_queue = Queue()
+        if watching:
+            self.watch_processes()
 
     def add_listener(self, listener, event_class, source):
         if not issubclass(event_class, Event):
@@ -81,6 +236,7 @@ class EventRouter:
         handlers.append(listener.handle_event)
         source_dict[source] = handlers
         self.dispatch_table[event_class] = source_dict
+        self.dispatch_cache.clear()
         reg_entry = self.listener_registry.get(listener,[])
         reg_entry.append((event_class,source))
         self.listener_registry[listener] = reg_entry
@@ -93,6 +249,7 @@ class EventRouter:
     def add_wildcard_listener(self, listener, event_class, source):
         self.add_listener(listener, event_class, source)
         self.wildcard_registry[listener.handle_event] = True
+        self.dispatch_cache.clear()
 
     def remove_listener(self, listener, event_class, source):
         try:
@@ -100,6 +257,7 @@ class EventRouter:
         except: pass
         if not issubclass(event_class, Event):
             raise TypeError('% is not an Event' % event_class)
+        self.dispatch_cache.clear()
         source_dict = self.dispatch_table.get(event_class)
         if source_dict is None: return
         handlers = source_dict.get(source)
@@ -127,59 +285,184 @@ class EventRouter:
         except: pass
 
     def _get_listeners(self,event):
-        source_dict = self.dispatch_table.get(type(event), None)
+        """Handlers for this event, wildcards last.  The tuple is cached
+        per (event class, source) until any listener changes."""
+        event_class = type(event)
+        cache = self.dispatch_cache.get(event_class)
+        if cache is None:
+            cache = dict()
+            self.dispatch_cache[event_class] = cache
+        else:
+            listeners = cache.get(event.source)
+            if listeners is not None:
+                return listeners
+        source_dict = self.dispatch_table.get(event_class, None)
         if source_dict is None:  # no listeners for this event type
-            return []
-        source_matches = source_dict.get(event.source, [])
-        wildcards = []
-        matches = []
-        for handler in source_matches:
-            if self.wildcard_registry.get(handler,False) is True:
-                wildcards.append(handler)
-            else:
-                matches.append(handler)
-        # wildcard handlers must come last in the list
-        if type(event).__name__ == 'PilotEvent':
-            print('event=',event,'   event.source=', repr(event.source))
-            print('wildcard_registry is',self.wildcard_registry)
-            print('matches=',matches,'   wildcards=',wildcards)
-        return matches + wildcards
+            listeners = ()
+        else:
+            source_matches = source_dict.get(event.source, [])
+            wildcards = []
+            matches = []
+            for handler in source_matches:
+                if self.wildcard_registry.get(handler,False) is True:
+                    wildcards.append(handler)
+                else:
+                    matches.append(handler)
+            # wildcard handlers must come last in the list
+            listeners = tuple(matches + wildcards)
+        cache[event.source] = listeners
+        return listeners
 
     def post(self,event):
+        """Queue the event for its listeners.  Queued events are delivered
+        by a single drain callback on the robot's event loop, higher
+        priority events first (see drain), but events from the same
+        source are always delivered in the order they were posted: an
+        event is queued at no higher a priority than any event from its
+        source that is still waiting.  E.g., a node's DataEvent is
+        delivered before the FailureEvent it posts next."""
         if not isinstance(event,Event):
             raise TypeError('%s is not an Event' % event)
         listeners = self._get_listeners(event)
-        cnt = 0
+        if not listeners:
+            if self.metrics:
+                self.metrics.record_post(event, 0)
+            return
+        if self.metrics:
+            self.metrics.record_post(event, len(listeners))
+            post_time = time.time()
+        else:
+            post_time = None
+        priority = event.priority
+        source = event.source
+        if source is not None:
+            queued = self.queued_sources.get(source)
+            if queued is None:
+                self.queued_sources[source] = [priority, 1]
+            else:
+                priority = queued[0] = max(priority, queued[0])
+                queued[1] += 1
+        queue = self.dispatch_queues[priority]
         for listener in listeners:
-            cnt += 1
             if TRACE.trace_level >= TRACE.listener_invocation:
                 print('TRACE%d:' % TRACE.listener_invocation, listener.__self__, 'receiving', event)
-            self.robot.loop.call_soon(listener,event)
-    
+            queue.append((listener, event, post_time, None))
+        queue[-1] = (listener, event, post_time, source)
+        if self.drain_handle is None and not self.draining:
+            self.drain_handle = self.robot.loop.call_soon(self.drain)
+
+    def drain(self):
+        """Run the handlers queued by post.  A drain runs the batch of
+        handlers that were queued when it began, highest priority first;
+        events posted by those handlers wait for the next drain.  So a
+        chain of events can't starve the event loop, and an endless chain
+        of normal events can't keep low priority ones waiting forever.
+        Only high priority events go ahead of the rest of the batch."""
+        self.drain_handle = None
+        self.draining = True  # post needn't schedule us while we run
+        batch = self.dispatch_queues
+        self.dispatch_queues = tuple(deque() for queue in batch)
+        self.drain_batch = batch
+        urgent = self.dispatch_queues[HIGH_PRIORITY]
+        queues = (batch[HIGH_PRIORITY], urgent) + batch[HIGH_PRIORITY+1:]
+        urgent_budget = sum(len(queue) for queue in batch)
+        count = 0
+        try:
+            while True:
+                for queue in queues:
+                    if queue and (queue is not urgent or urgent_budget > 0):
+                        break
+                else:
+                    break
+                if queue is urgent:
+                    urgent_budget -= 1
+                (handler, event, post_time, source) = queue.popleft()
+                count += 1
+                if source is not None:
+                    queued = self.queued_sources.get(source)
+                    if queued:
+                        queued[1] -= 1
+                        if queued[1] == 0:
+                            del self.queued_sources[source]
+                if post_time is not None and self.metrics:
+                    self.metrics.call_handler(handler, event, post_time)
+                else:
+                    handler(event)
+        finally:
+            # If a handler raised, the loop reports it and the rest of
+            # the batch runs next tick, ahead of anything posted since.
+            self.draining = False
+            self.drain_batch = None
+            if any(batch):
+                for (queue, posted) in zip(batch, self.dispatch_queues):
+                    queue.extend(posted)
+                self.dispatch_queues = batch
+            if self.metrics:
+                self.metrics.record_drain(count)
+            if any(self.dispatch_queues) and self.drain_handle is None:
+                self.drain_handle = self.robot.loop.call_soon(self.drain)
+
     def add_process_node(self, node):
-        self.processes[id(node)] = node
+        "Register a new job for node and return its job id."
+        job_id = self.next_job_id
+        self.next_job_id += 1
+        self.processes[job_id] = node
+        return job_id
 
     def delete_process_node(self, node):
-        node_id = id(node)
-        if node_id in self.processes:
-            del self.processes[node_id]
-            # print('Deleted id',node_id,'for',node)
+        job_id = getattr(node, 'job_id', None)
+        if self.processes.get(job_id) is node:
+            del self.processes[job_id]
+            # print('Deleted job',job_id,'for',node)
         else:
-            print('*** ERROR in delete_process_node: node',node_id,'not in process dict!')
+            print('*** ERROR in delete_process_node: job',job_id,'of',node,'not in process dict!')
 
+    # Only used if the event loop can't watch file descriptors.
     POLLING_INTERVAL = 0.1
 
+    def watch_processes(self):
+        """Have the event loop call deliver_process_events as soon as the
+        interprocess queue's pipe has data, so results from processes
+        are posted without delay.  Falls back to polling the queue if the
+        loop can't watch the pipe (e.g., the Windows proactor loop)."""
+        try:
+            fd = self.interprocess_queue._reader.fileno()
+            self.robot.loop.add_reader(fd, self.deliver_process_events)
+            self.process_reader_fd = fd
+        except (AttributeError, NotImplementedError):
+            print('EventRouter: polling for process events every', self.POLLING_INTERVAL, 'seconds')
+            self.poll_processes()
+
+    def unwatch_processes(self):
+        "Stop watching the interprocess queue.  Returns True if we were watching it."
+        watching = False
+        if self.process_reader_fd is not None:
+            self.robot.loop.remove_reader(self.process_reader_fd)
+            self.process_reader_fd = None
+            watching = True
+        if self.process_poll_handle is not None:
+            self.process_poll_handle.cancel()
+            self.process_poll_handle = None
+            watching = True
+        return watching
+
     def poll_processes(self):
+        self.deliver_process_events()
+        self.process_poll_handle = \
+            self.robot.loop.call_later(self.POLLING_INTERVAL, self.poll_processes)
+
+    def deliver_process_events(self):
         while not self.interprocess_queue.empty():
-            (id,event) = self.interprocess_queue.get()
-            if id in self.processes:
-                node = self.processes[id]
-                event.source = node
-                print('Node %s returned %s' % (node,event))
-                self.post(event)
-            else:
-                print('*** ERROR in poll_processes: node',id,'not in process dict!', self.processes)
-        self.robot.loop.call_later(self.POLLING_INTERVAL, self.poll_processes)
+            (job_id,event) = self.interprocess_queue.get()
+            node = self.processes.get(job_id)
+            if node is None:
+                # The node was stopped or restarted since it launched this job.
+                print('Dropped %s from stale job %s' % (event, job_id))
+                continue
+            event = node.unpack_process_event(event)
+            event.source = node
+            print('Node %s returned %s' % (node,event))
+            self.post(event)
 
 #________________ Event Listener ________________
 
@@ -232,7 +515,13 @@ class EventListener:
         if self.running and self.polling_interval:
             self.poll_handle = \
                 self.robot.loop.call_later(self.polling_interval, self._next_poll)
-            self.poll()
+            metrics = self.robot.erouter.metrics
+            if metrics:
+                start_time = time.time()
+                self.poll()
+                metrics.record_listener(self, time.time() - start_time, 'poll')
+            else:
+                self.poll()
 
     def poll(self):
         """Dummy polling function in case sublass neglects to supply one."""
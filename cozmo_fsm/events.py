@@ -5,7 +5,7 @@
 
 import cozmo
 
-from .evbase import Event
+from .evbase import Event, HIGH_PRIORITY, LOW_PRIORITY
 
 class CompletionEvent(Event):
     """Signals completion of a state node's action."""
@@ -21,6 +21,8 @@ class SuccessEvent(Event):
 
 class FailureEvent(Event):
     """Signals failure of a state node's action."""
+    priority = HIGH_PRIORITY
+
     def __init__(self,details=None):
         super().__init__()
         self.details = details
@@ -40,8 +42,19 @@ class DataEvent(Event):
         self.data = data
 
 
+class ProgressEvent(Event):
+    """Intermediate result of a long computation, such as a first path
+    before smoothing finishes.  The final result follows as a DataEvent
+    or other event."""
+    def __init__(self,data):
+        super().__init__()
+        self.data = data
+
+
 class TextMsgEvent(Event):
     """Signals a text message broadcasted to the state machine."""
+    priority = LOW_PRIORITY
+
     def __init__(self,string,words=None,result=None):
         super().__init__()
         self.string = string
@@ -50,6 +63,8 @@ class TextMsgEvent(Event):
 
 class SpeechEvent(Event):
     """Results of speech recognition process."""
+    priority = LOW_PRIORITY
+
     def __init__(self,string,words=None,result=None):
         super().__init__()
         self.string = string
@@ -88,9 +103,11 @@ class TapEvent(CozmoGeneratedEvent):
     cozmo_evt_type = cozmo.objects.EvtObjectTapped
 
 class FaceEvent(CozmoGeneratedEvent):
+    priority = LOW_PRIORITY
     cozmo_evt_type = cozmo.faces.EvtFaceAppeared
 
 class ObservedMotionEvent(CozmoGeneratedEvent):
+    priority = LOW_PRIORITY
     cozmo_evt_type = cozmo.camera.EvtRobotObservedMotion
 
     def __repr__(self):
@@ -118,6 +135,7 @@ class ObservedMotionEvent(CozmoGeneratedEvent):
 
 
 class UnexpectedMovementEvent(CozmoGeneratedEvent):
+    priority = HIGH_PRIORITY
     cozmo_evt_type = cozmo.robot.EvtUnexpectedMovement
 
     def __repr__(self):
@@ -6,7 +6,6 @@ kinematics.
 
 import numpy as np
 from math import sin, cos, tan, pi, atan2, asin, sqrt, floor, ceil
-from fractions import Fraction
 import copy
 
 def point(x=0,y=0,z=0):
@@ -330,6 +329,79 @@ def segment_intersect_test(p1, p2, p3, p4):
         return False
 
 
+def segments_intersect(starts, ends, seg_starts, seg_ends):
+    """Vectorized segment_intersect_test of every segment starts[i]-ends[i]
+    against every segment seg_starts[j]-seg_ends[j].  Arguments are
+    arrays of (x,y) points, shaped n x 2 and m x 2.  Returns an n x m
+    boolean array."""
+    p1 = np.asarray(starts, dtype=float).reshape(-1,1,2)
+    p2 = np.asarray(ends, dtype=float).reshape(-1,1,2)
+    p3 = np.asarray(seg_starts, dtype=float).reshape(1,-1,2)
+    p4 = np.asarray(seg_ends, dtype=float).reshape(1,-1,2)
+    (x1, y1, x2, y2) = (p1[...,0], p1[...,1], p2[...,0], p2[...,1])
+    (x3, y3, x4, y4) = (p3[...,0], p3[...,1], p4[...,0], p4[...,1])
+    denom = (x4-x3)*(y1-y2) - (x1-x2)*(y4-y3)
+    parallel = np.abs(denom) < 0.0001
+    denom = np.where(parallel, 1, denom)
+    ta = ((y3-y4)*(x1-x3) + (x4-x3)*(y1-y3)) / denom
+    tb = ((y1-y2)*(x1-x3) + (x2-x1)*(y1-y3)) / denom
+    return ~parallel & (0 <= ta) & (ta <= 1) & (0 <= tb) & (tb <= 1)
+
+def first_crossing(points, seg_starts, seg_ends):
+    """Find the first leg of the polyline through points that crosses
+    any of the segments seg_starts[j]-seg_ends[j].  Returns (i, j) where
+    the leg runs from points[i] to points[i+1] and j is the lowest
+    numbered segment it crosses, or None."""
+    points = np.asarray(points, dtype=float).reshape(-1,2)
+    if len(points) < 2 or len(seg_starts) == 0:
+        return None
+    hits = segments_intersect(points[:-1], points[1:], seg_starts, seg_ends)
+    crossed = np.flatnonzero(hits.any(1))
+    if len(crossed) == 0:
+        return None
+    i = crossed[0]
+    return (int(i), int(np.argmax(hits[i])))
+
+def points_in_polygon(xs, ys, vertices):
+    """Vectorized even-odd test of which points lie inside a polygon.
+    xs and ys are arrays of the same shape; vertices has the x
+    coordinates in row 0 and the y coordinates in row 1 (homogeneous
+    coordinates are fine).  Works for concave polygons too.
+    Returns a boolean array shaped like xs."""
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    vx = np.asarray(vertices[0], dtype=float).ravel()
+    vy = np.asarray(vertices[1], dtype=float).ravel()
+    inside = np.zeros(xs.shape, dtype=bool)
+    N = len(vx)
+    for i in range(N):
+        (x1, y1) = (vx[i], vy[i])
+        (x2, y2) = (vx[(i+1)%N], vy[(i+1)%N])
+        if y1 == y2: continue  # horizontal edges never cross a scanline
+        crosses = (y1 > ys) != (y2 > ys)
+        x_cross = x1 + (ys - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (xs < x_cross)
+    return inside
+
+def polygon_edge_distance(xs, ys, vertices):
+    """Vectorized distance from each point to the nearest edge of a polygon."""
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    vx = np.asarray(vertices[0], dtype=float).ravel()
+    vy = np.asarray(vertices[1], dtype=float).ravel()
+    dist = np.full(xs.shape, np.inf)
+    N = len(vx)
+    for i in range(N):
+        (x1, y1) = (vx[i], vy[i])
+        (dx, dy) = (vx[(i+1)%N] - x1, vy[(i+1)%N] - y1)
+        lensq = dx*dx + dy*dy
+        if lensq == 0:
+            t = 0
+        else:
+            t = np.clip(((xs - x1)*dx + (ys - y1)*dy) / lensq, 0, 1)
+        dist = np.minimum(dist, np.hypot(xs - (x1 + t*dx), ys - (y1 + t*dy)))
+    return dist
+
 def rotation_matrix_to_euler_angles(R):
     "Input R is a 3x3 rotation matrix."
     sy = sqrt(R[0,0] * R[0,0] +  R[1,0] * R[1,0])
@@ -346,89 +418,41 @@ def rotation_matrix_to_euler_angles(R):
     return np.array([x, y, z])
 
 
+def polygon_mask(xs, ys, vertices, offset=-1, pad=0):
+    """Vectorized polygon rasterization.  Returns a boolean array shaped
+    like xs marking the points (xs,ys) of the polygon's goal region,
+    using polygon_fill's offset convention: a negative offset insets the
+    polygon by |offset| mm from its edges, and a non-negative offset
+    keeps only a box of half-width offset+pad around the polygon's
+    center.  If the center falls outside a concave polygon, the most
+    interior of the given points is used as the center instead."""
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    inside = points_in_polygon(xs, ys, vertices)
+    if offset < 0:
+        return inside & (polygon_edge_distance(xs, ys, vertices) >= -offset)
+    cx = np.asarray(vertices[0], dtype=float).mean()
+    cy = np.asarray(vertices[1], dtype=float).mean()
+    if not points_in_polygon(np.array([cx]), np.array([cy]), vertices)[0]:
+        candidates = np.flatnonzero(inside)
+        if candidates.size == 0:
+            return inside
+        depth = polygon_edge_distance(xs.ravel()[candidates], ys.ravel()[candidates], vertices)
+        best = candidates[np.argmax(depth)]
+        (cx, cy) = (xs.ravel()[best], ys.ravel()[best])
+    half_width = offset + pad
+    return inside & (np.abs(xs - cx) <= half_width) & (np.abs(ys - cy) <= half_width)
+
 def polygon_fill(polygon, offset):
     """
-    Implement the scanline polygon fill algorithm
-    Input a polygon (rrt shape) and return points inside the polygon
+    Return the integer points inside the polygon (rrt shape), as a list
+    of [x,y] pairs.  See polygon_mask() for the meaning of offset.
     """
-    class Edge:
-        def __init__(self, ymax, x, sign, dx, dy, sum):
-            self.ymax = ymax
-            self.xval = x
-            self.sign = sign
-            self.dx = dx
-            self.dy = dy
-            self.sum = sum
-        def __repr__(self):
-            return '<Edge (ymax= %s, xval= %s, sign= %s, dx= %s, dy= %s, sum= %s )>' % \
-                   (self.ymax, self.xval, self.sign, self.dx, self.dy, self.sum)
-
-    [xCenter, yCenter, _, _] = polygon.vertices.mean(1)
-    edges = polygon.edges
     ((xmin,ymin), (xmax,ymax)) = polygon.get_bounding_box()
-    xmin, ymin, xmax, ymax = floor(xmin), floor(ymin), ceil(xmax), ceil(ymax)
-    xdelta = abs(xmin) if xmin < 0 else 0
-    xmin += xdelta
-    xmax += xdelta
-    xCenter += xdelta
-    ydelta = abs(ymin) if ymin < 0 else 0
-    ymin += ydelta
-    ymax += ydelta
-    yCenter += ydelta
-    edge_table = [[] for i in range(ymax+1)]
-    active_list, points = [], []
-
-    for edge in edges:
-        ([[p1x], [p1y], _, _], [[p2x], [p2y], _, _]) = edge
-        if (p1y-p2y) != 0:  # Don't need to consider horizontal edges
-            p1x, p1y, p2x, p2y = p1x+xdelta, p1y+ydelta, p2x+xdelta, p2y+ydelta
-            end_points = [[p1x, p1y], [p2x, p2y]]
-            end_points = sorted(end_points, key = lambda pt: pt[1])   # Sort on y value
-            _xval, _ymin, _ymax = int(round(end_points[0][0])), int(round(end_points[0][1])), int(round(end_points[1][1]))
-            slope = Fraction((p1x-p2x)/(p1y-p2y)).limit_denominator(10)
-            _dx = slope.numerator
-            _dy = slope.denominator
-            _sign = 1 if (_dx > 0) == (_dy > 0) else -1
-            _edge = Edge(_ymax, _xval, _sign, abs(_dx), abs(_dy), 0)
-            edge_table[_ymin].append(_edge)
-
-    for scanline in range(ymin, ymax+1):
-        # Add match (ymin==scanline) edges to the active_list
-        if len(edge_table[scanline]) > 0:
-            for edge in edge_table[scanline]:
-                active_list.append(edge)
-        if len(active_list) > 0:
-            y_lower_bound = (ymin - offset) if (offset < 0) else (yCenter - offset)
-            y_upper_bound = (ymax + offset) if (offset < 0) else (yCenter + offset)
-            if y_lower_bound < scanline < y_upper_bound:
-                # Sort active_list on x value; if same x value, sort on slope (1/m)
-                active_list = sorted(active_list, key = lambda x: (x.xval, x.sign*x.dx/x.dy))
-                for _x in range(active_list[0].xval, active_list[1].xval):
-                    x_lower_bound = (active_list[0].xval - offset) if (offset < 0) else (xCenter - offset)
-                    x_upper_bound = (active_list[1].xval + offset) if (offset < 0) else (xCenter + offset)
-                    if x_lower_bound < _x < x_upper_bound:
-                        points.append([_x-xdelta, scanline-ydelta])
-        if len(active_list) > 3:
-            y_lower_bound = (ymin - offset) if (offset < 0) else (yCenter - offset)
-            y_upper_bound = (ymax + offset) if (offset < 0) else (yCenter + offset)
-            if y_lower_bound < scanline < y_upper_bound:
-                for _x in range(active_list[2].xval, active_list[3].xval):
-                    x_lower_bound = (active_list[2].xval - offset) if (offset < 0) else (xCenter - offset)
-                    x_upper_bound = (active_list[3].xval + offset) if (offset < 0) else (xCenter + offset)
-                    if x_lower_bound < _x < x_upper_bound:
-                        points.append([_x-xdelta, scanline-ydelta])
-        # Remove form active_list if edge.ymax = scanline
-        active_list = [edge for edge in active_list if scanline < edge.ymax]
-        # Increase x-value
-        for edge in active_list:
-            # Add dx to sum
-            edge.sum += edge.dx
-            # While sum ≥ dy, adjust x, subtract dy from sum
-            while edge.sum >= edge.dy:
-                edge.xval += edge.sign
-                edge.sum -= edge.dy
-
-    return points
+    (xs, ys) = np.meshgrid(np.arange(floor(xmin), ceil(xmax)+1),
+                           np.arange(floor(ymin), ceil(ymax)+1), indexing='ij')
+    mask = polygon_mask(xs, ys, polygon.vertices, offset)
+    return np.stack((xs[mask], ys[mask]), axis=1).tolist()
 
 def check_concave(polygon):
     """
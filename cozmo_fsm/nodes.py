@@ -1283,6 +1283,7 @@ class LaunchProcess(StateNode):
     def __init__(self):
         super().__init__()
         self.process = None
+        self.job_id = None
 
     @staticmethod
     def process_workhorse(reply_token):
@@ -1306,16 +1307,49 @@ class LaunchProcess(StateNode):
         event_pair = (id, event)
         queue.put(event_pair)
 
+    def create_job(self):
+        """Return (workhorse, args) to run this node's computation on the
+        job queue as workhorse(reply_token, *args), or None to launch a
+        process with create_process instead."""
+        return None
+
+    def job_queue(self):
+        """Where create_job's jobs go: an object with a method
+        submit(workhorse, job_id, args, reply_queue), normally the
+        robot's worker pool.  None means use create_process."""
+        return getattr(self.robot, 'worker_pool', None)
+
     def create_process(self, reply_token):
         p = Process(target=self.__class__.process_workhorse,
                     args=[reply_token])
         return p
 
+    def unpack_process_event(self, event):
+        """Called in the parent process for each event the child posts,
+        before the event is delivered.  Override to absorb data the child
+        sent back for the parent's own use."""
+        return event
+
     def start(self, event=None):
+        if self.running: return
         super().start(event)
-        reply_token = (id(self), self.robot.erouter.interprocess_queue)
+        self.launch()
+
+    def launch(self):
+        """Run this activation's job.  Each job gets its own job id from
+        the event router, and replies are routed by job id, so a job
+        left over from an earlier activation can't reach this one."""
+        self.job_id = self.robot.erouter.add_process_node(self)
+        reply_queue = self.robot.erouter.interprocess_queue
+        queue = self.job_queue()
+        job = self.create_job() if queue else None
+        if job:
+            (workhorse, args) = job
+            queue.submit(workhorse, self.job_id, args, reply_queue)
+            print('Submitted', self, 'to', queue)
+            return
+        reply_token = (self.job_id, reply_queue)
         self.process = self.create_process(reply_token)
-        self.robot.erouter.add_process_node(self)
         self.process.start()
         print('Launched', self.process)
 
@@ -2,20 +2,57 @@
 Path planner using RRT and Wavefront algorithms.
 """
 
-from math import pi, sin, cos
+import hashlib
+import time
+import numpy as np
+from collections import OrderedDict, deque
+from math import pi, sin, cos, sqrt, atan2, ceil
 from multiprocessing import Process
 
+from .base import StateNode
 from .nodes import LaunchProcess
-from .events import DataEvent, PilotEvent
+from .events import DataEvent, PilotEvent, ProgressEvent
 from .pilot0 import NavPlan, NavStep
 from .worldmap import WorldObject, LightCubeObj, ChargerObj, CustomMarkerObj, RoomObj, DoorwayObj
-from .rrt import RRT, RRTNode, StartCollides, GoalCollides, GoalUnreachable
+from .rrt import RRT, RRTNode, StartCollides, GoalCollides, GoalUnreachable, PlanningAborted
+from .rrt_shapes import pack_shapes, unpack_shapes, table_digest
+from .worker_pool import SharedArray, CancelToken
 from .wavefront import WaveFront
-from .geometry import wrap_angle, segment_intersect_test
+from .geometry import wrap_angle, first_crossing
 from .doorpass import DoorPass
+from .topology import get_room_graph
 
 from . import rrt
 
+class PlanStats():
+    """Where one plan's time went: seconds per phase, plus counters such
+    as cells expanded and collision checks.  Phases are setup and
+    obstacles (in the parent process), raster, inflate, escape, goal,
+    propagate or astar, extract, smooth, backoff, and from_path; total
+    is the whole plan, and round_trip the time a PathPlannerProcess
+    waited for its worker."""
+    def __init__(self):
+        self.times = OrderedDict()
+        self.counters = OrderedDict()
+
+    def __repr__(self):
+        times = ', '.join('%s %.1f' % (phase, t*1000) for (phase, t) in self.times.items())
+        counters = ', '.join('%s=%d' % item for item in self.counters.items())
+        return '<PlanStats ms: %s; %s>' % (times, counters)
+
+    def add_time(self, phase, seconds):
+        self.times[phase] = self.times.get(phase, 0) + seconds
+
+    def count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def merge(self, other):
+        for (phase, t) in other.times.items():
+            self.add_time(phase, t)
+        for (counter, n) in other.counters.items():
+            self.count(counter, n)
+
+
 class PathPlanner():
     """This path planner can be called directly, or it can be used inside
     a PathPlannerProcess node that runs the heavy lifting portion of
@@ -45,17 +82,108 @@ class PathPlanner():
     skinny_wall_inflation = 10
     skinny_doorway_adjustment = 0
 
+    # Only the skinny obstacles are generated.  The wavefront grid
+    # rasterizes them once and grows them to fat size by thresholding a
+    # distance transform (WaveFront.inflated).  Walls grow by half the
+    # fat doorway narrowing on each side.  If the goal is unreachable we
+    # retry with the growth scaled down.
+    obstacle_growth = fat_obstacle_inflation - skinny_obstacle_inflation
+    wall_growth = (skinny_doorway_adjustment - fat_doorway_adjustment) / 2
+    inflation_retry_scales = (1, 0.5)
+
+    # Coarse-to-fine wavefront: solve on a coarse grid first, then
+    # refine at full resolution only within a corridor around the
+    # coarse path.  Falls back to a single full-resolution grid if
+    # either stage fails.
+    coarse_to_fine = True
+    coarse_square_size = 20  # mm
+    corridor_half_width = 120  # mm
+
+    # Hierarchical planning: when the map has rooms, route through the
+    # room/doorway graph first and confine the grid search to the rooms
+    # on the route, grown by region_margin so their doorways connect.
+    use_room_graph = True
+    region_margin = 60  # mm
+
+    # Grid search engine used by do_planning unless the caller picks
+    # one: 'wavefront' floods outward from the start (coarse-to-fine or
+    # via a cached goal field, as configured above and below), while
+    # 'astar' uses an octile-distance heuristic and expands far fewer
+    # cells on point-to-point plans across open space.
+    search_engine = 'wavefront'
+
+    # Goal-rooted distance fields, kept so that repeated trips to the
+    # same goal (e.g., the charger) skip the wavefront fill entirely and
+    # just descend the stored field from the new start.  A field covers
+    # the whole grid, so it costs more than one coarse-to-fine search;
+    # it is built only once a goal has been planned to
+    # goal_field_min_requests times.  Fields see only the static
+    # obstacles (those whose ids start with static_obstacle_prefixes),
+    # so cubes moving around don't invalidate them; a descended path
+    # is checked against the other obstacles before it is used.  Keys
+    # come from goal_field_key(); the least recently used field is
+    # dropped first.  The cache belongs to the process that plans:
+    # each pool worker, or the planning service, keeps its own, and
+    # fields are never shipped between processes.
+    reuse_goal_fields = True
+    goal_field_min_requests = 2
+    goal_field_cache_size = 8
+    goal_fields = OrderedDict()
+    goal_field_requests = OrderedDict()  # goal field key -> plans to that goal
+    static_obstacle_prefixes = ('Wall',)
+
+    # Finished plans, so that repeated trips to the same goal from about
+    # the same place skip planning altogether.  Keys come from
+    # plan_cache_key(): the start pose quantized to plan_cache_xy_step mm
+    # and plan_cache_theta_step radians, the goals and their poses
+    # quantized the same way, the inflation settings, and the engine.
+    # The key leaves out the world map version, which changes whenever
+    # anything on the map moves; instead a cached plan is re-checked for
+    # collisions with the current obstacles before it is used.
+    reuse_plans = True
+    plan_cache_size = 16
+    plan_cache_xy_step = 25  # mm
+    plan_cache_theta_step = 15/180*pi
+    plan_cache = OrderedDict()
+    plan_cache_stats = dict(hits=0, misses=0, rejected=0)
+
+    # Anytime planning: PathPlannerProcess gives up on the search after
+    # time_budget seconds (None for no limit), and cuts smoothing short,
+    # keeping the path smoothed so far.  While smoothing, the partial
+    # plan is posted as a ProgressEvent every progress_interval seconds.
+    time_budget = None
+    progress_interval = 0.25
+
+    # PlanStats for recent plans, for timing_stats() and timing_histogram().
+    # Set print_stats to print each plan's stats as it is recorded.
+    STATS_HISTORY_LENGTH = 200
+    stats_history = deque(maxlen=STATS_HISTORY_LENGTH)
+    print_stats = False
+
     @staticmethod
-    def plan_path_this_process(goal_object, robot, use_doorways=False):
+    def plan_path_this_process(goal_object, robot, use_doorways=False, engine=None):
+        """goal_object may also be a list of candidate goals, in which case
+        we plan to the nearest reachable one.  The result then has a
+        goal_ranking attribute listing (goal_object, cost_mm) for every
+        reachable goal, nearest first."""
+        start_time = time.time()
+        stats = PlanStats()
         # Get pickle-able data structures
         (start_node, goal_shape, robot_parts, bbox,
-         fat_obstacles, skinny_obstacles, doorway_list, need_grid_display) = \
-            __class__.setup_problem(goal_object, robot, use_doorways)
-        # Do the actual path planning
-        result = \
-            __class__.do_planning(robot.world.rrt, start_node, goal_shape,
-                                  fat_obstacles, skinny_obstacles, doorway_list,
-                                  need_grid_display)
+         obstacles, doorway_list, need_grid_display, route_rooms) = \
+            __class__.setup_problem(goal_object, robot, use_doorways, stats)
+        cache_key = __class__.plan_cache_key(start_node, goal_object, robot, use_doorways, engine)
+        result = __class__.cached_plan(cache_key, robot.world.rrt, start_node, stats)
+        if result is None:
+            # Do the actual path planning
+            result = \
+                __class__.do_planning(robot.world.rrt, start_node, goal_shape,
+                                      obstacles, doorway_list, need_grid_display,
+                                      route_rooms, engine=engine, stats=stats)
+            __class__.store_plan(cache_key, result)
+        stats.add_time('total', time.time() - start_time)
+        result.stats = stats
+        __class__.record_stats(stats)
         if isinstance(result, PilotEvent):
             grid_display = result.args['grid_display']
         elif isinstance(result, DataEvent):
@@ -63,36 +191,204 @@ class PathPlanner():
         else:
             ValueError('Bad result type:', result)
         robot.world.rrt.grid_display = grid_display
+        return __class__.unpack_goal_ranking(result, goal_object)
+
+    @staticmethod
+    def unpack_goal_ranking(result, goal_objects):
+        "Convert goal indices in a multi-goal result back to goal objects."
+        if hasattr(result, 'goal_ranking'):
+            result.goal_ranking = [(goal_objects[i], cost) for (i, cost) in result.goal_ranking]
         return result
 
     @staticmethod
-    def setup_problem(goal_object, robot, use_doorways):
-        """Calculate values from world map in main process since the map won't
-        be available in the child process."""
+    def record_stats(stats):
+        if PathPlanner.print_stats:
+            print('PathPlanner timing:', stats)
+        PathPlanner.stats_history.append(stats)
+
+    @staticmethod
+    def timing_stats():
+        """Summarize phase times (ms) and counters over recent plans.
+        Returns a dict of name -> dict(plans, median, p90, max)."""
+        samples = OrderedDict()
+        for stats in PathPlanner.stats_history:
+            for (phase, t) in stats.times.items():
+                samples.setdefault(phase, []).append(t * 1000)
+            for (counter, n) in stats.counters.items():
+                samples.setdefault(counter, []).append(n)
+        summary = OrderedDict()
+        for (name, values) in samples.items():
+            values = sorted(values)
+            summary[name] = dict(plans = len(values),
+                                 median = values[len(values)//2],
+                                 p90 = values[min(len(values)-1, int(len(values)*0.9))],
+                                 max = values[-1])
+        return summary
 
-        # Fat obstacles and narrow doorways for WaveFront
-        robot.world.rrt.generate_obstacles(PathPlanner.fat_obstacle_inflation,
-                                           PathPlanner.fat_wall_inflation,
-                                           PathPlanner.fat_doorway_adjustment)
-        fat_obstacles = robot.world.rrt.obstacles
+    @staticmethod
+    def timing_histogram(phase='total', bin_ms=10):
+        """Histogram of a phase's times over recent plans, as a list of
+        (bin_start_ms, count) for the nonempty bins."""
+        counts = dict()
+        for stats in PathPlanner.stats_history:
+            if phase in stats.times:
+                bin = int(stats.times[phase] * 1000 // bin_ms) * bin_ms
+                counts[bin] = counts.get(bin, 0) + 1
+        return sorted(counts.items())
+
+    @staticmethod
+    def show_timing_stats():
+        summary = PathPlanner.timing_stats()
+        if not summary:
+            print('No path plans yet.')
+            return
+        print('%-20s %6s %10s %10s %10s' % ('', 'plans', 'median', 'p90', 'max'))
+        for (name, s) in summary.items():
+            print('%-20s %6d %10.1f %10.1f %10.1f' %
+                  (name, s['plans'], s['median'], s['p90'], s['max']))
 
-        # Skinny obstacles and normal doorways for RRT
+    @staticmethod
+    def plan_cache_key(start_node, goal_object, robot, use_doorways, engine=None):
+        "Key for plan_cache."
+        goals = goal_object if isinstance(goal_object, (list,tuple)) else [goal_object]
+        step = PathPlanner.plan_cache_xy_step
+        headings = int(round(2*pi / PathPlanner.plan_cache_theta_step))
+        def pose(x, y, theta):
+            return (int(round(x / step)), int(round(y / step)),
+                    int(round(theta / PathPlanner.plan_cache_theta_step)) % headings)
+        carrying = robot.carrying.id if robot.carrying else None
+        return (pose(start_node.x, start_node.y, start_node.q),
+                tuple((goal.id,) + pose(goal.x, goal.y, getattr(goal, 'theta', 0))
+                      for goal in goals),
+                (PathPlanner.skinny_obstacle_inflation, PathPlanner.skinny_wall_inflation,
+                 PathPlanner.skinny_doorway_adjustment) + PathPlanner.inflation(),
+                engine or PathPlanner.search_engine, use_doorways, carrying)
+
+    @staticmethod
+    def cached_plan(key, rrt_instance, start_node, stats=None):
+        """A DataEvent holding a copy of the plan cached under key, made to
+        start at start_node, or None.  A plan the robot would now collide
+        along is dropped from the cache.  rrt_instance must hold the
+        current obstacles."""
+        if not PathPlanner.reuse_plans:
+            return None
+        lookup_start_time = time.time()
+        entry = PathPlanner.plan_cache.get(key)
+        if entry is None:
+            PathPlanner.plan_cache_stats['misses'] += 1
+            return None
+        (navplan, grid_display, goal_ranking) = entry
+        navplan = PathPlanner.copy_navplan(navplan, start_node)
+        if PathPlanner.plan_collides(rrt_instance, navplan):
+            print('PathPlanner: cached plan now collides; replanning')
+            del PathPlanner.plan_cache[key]
+            PathPlanner.plan_cache_stats['rejected'] += 1
+            return None
+        PathPlanner.plan_cache.move_to_end(key)
+        PathPlanner.plan_cache_stats['hits'] += 1
+        result = DataEvent((navplan, grid_display))
+        if goal_ranking is not None:
+            result.goal_ranking = list(goal_ranking)
+        if stats:
+            stats.add_time('plan_cache', time.time() - lookup_start_time)
+            stats.count('plan_cache_hits')
+        return result
+
+    @staticmethod
+    def store_plan(key, result):
+        """Cache a successful plan.  Plans that begin with an escape
+        backup are not cached, since the backup only makes sense from
+        the exact start pose."""
+        if not (PathPlanner.reuse_plans and isinstance(result, DataEvent)):
+            return
+        (navplan, grid_display) = result.data
+        if not navplan.steps or navplan.steps[0].type != NavStep.DRIVE:
+            return
+        PathPlanner.plan_cache[key] = (PathPlanner.copy_navplan(navplan), grid_display,
+                                       getattr(result, 'goal_ranking', None))
+        PathPlanner.plan_cache.move_to_end(key)
+        while len(PathPlanner.plan_cache) > PathPlanner.plan_cache_size:
+            PathPlanner.plan_cache.popitem(last=False)
+
+    @staticmethod
+    def plan_cache_summary():
+        "Plan cache hit, miss, and rejection counts and rates."
+        s = PathPlanner.plan_cache_stats
+        lookups = s['hits'] + s['misses'] + s['rejected']
+        return dict(s, lookups=lookups, size=len(PathPlanner.plan_cache),
+                    hit_rate = s['hits'] / lookups if lookups else 0.0,
+                    miss_rate = (s['misses'] + s['rejected']) / lookups if lookups else 0.0)
+
+    @staticmethod
+    def copy_navplan(navplan, start_node=None):
+        """Copy of a plan whose node lists can be changed freely.  If
+        start_node is given, the first DRIVE step starts there instead."""
+        steps = []
+        for step in navplan.steps:
+            if step.type == NavStep.DOORPASS:
+                steps.append(NavStep(step.type, step.param))
+            else:
+                steps.append(NavStep(step.type, [node.copy() for node in step.param]))
+        if start_node and steps and steps[0].type == NavStep.DRIVE:
+            steps[0].param[0].x = start_node.x
+            steps[0].param[0].y = start_node.y
+        return NavPlan(steps)
+
+    @staticmethod
+    def plan_legs(navplan):
+        "(start_node, end_node) pairs for each leg of the plan's DRIVE steps."
+        legs = []
+        for step in navplan.steps:
+            if step.type == NavStep.DRIVE:
+                legs += list(zip(step.param, step.param[1:]))
+        return legs
+
+    @staticmethod
+    def leg_poses(legs, step_size):
+        """Robot poses every step_size mm along each leg's chord, facing
+        along the chord.  Returns arrays (xs, ys, qs, leg_indices)."""
+        (xs, ys, qs, indices) = ([], [], [], [])
+        for (i, (a, b)) in enumerate(legs):
+            (dx, dy) = (b.x - a.x, b.y - a.y)
+            n = max(1, int(ceil(sqrt(dx*dx + dy*dy) / step_size)))
+            t = np.arange(n+1) / n
+            xs.append(a.x + t*dx)
+            ys.append(a.y + t*dy)
+            qs.append(np.full(n+1, atan2(dy, dx)))
+            indices.append(np.full(n+1, i))
+        if not legs:
+            return (np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0, dtype=int))
+        return tuple(np.concatenate(v) for v in (xs, ys, qs, indices))
+
+    @staticmethod
+    def plan_collides(rrt_instance, navplan):
+        """True if the robot would collide driving the plan's DRIVE steps
+        past rrt_instance's obstacles.  Each leg is checked along its
+        chord every step_size mm, all in one collides_poses batch."""
+        (xs, ys, qs, legs) = PathPlanner.leg_poses(PathPlanner.plan_legs(navplan),
+                                                   rrt_instance.step_size)
+        return bool(rrt_instance.collides_poses(xs, ys, qs).any())
+
+    @staticmethod
+    def setup_problem(goal_object, robot, use_doorways, stats=None):
+        """Calculate values from world map in main process since the map won't
+        be available in the child process.  Timings go into stats if supplied."""
+        start_time = time.time()
+
+        # Skinny obstacles and normal doorways; the WaveFront inflates its own.
         robot.world.rrt.generate_obstacles(PathPlanner.skinny_obstacle_inflation,
                                            PathPlanner.skinny_wall_inflation,
                                            PathPlanner.skinny_doorway_adjustment)
-        skinny_obstacles = robot.world.rrt.obstacles
+        obstacles = robot.world.rrt.obstacles
+        obstacles_time = time.time() - start_time
 
         (pose_x, pose_y, pose_theta) = robot.world.particle_filter.pose
         start_node = RRTNode(x=pose_x, y=pose_y, q=pose_theta)
 
-        if isinstance(goal_object, (LightCubeObj,ChargerObj)):
-            goal_shape = RRT.generate_cube_obstacle(goal_object)
-        elif isinstance(goal_object, CustomMarkerObj):
-            goal_shape = RRT.generate_marker_obstacle(goal_object)
-        elif isinstance(goal_object, RoomObj):
-            goal_shape = RRT.generate_room_obstacle(goal_object)
+        if isinstance(goal_object, (list,tuple)):
+            goal_shape = [PathPlanner.goal_object_shape(obj) for obj in goal_object]
         else:
-            raise ValueError("Can't convert path planner goal %s to shape." % goal_object)
+            goal_shape = PathPlanner.goal_object_shape(goal_object)
 
         robot_parts = robot.world.rrt.make_robot_parts(robot)
         bbox = robot.world.rrt.compute_bounding_box()
@@ -104,13 +400,55 @@ class PathPlanner():
 
         need_grid_display = robot.world.path_viewer is not None
 
+        # Vertices of the rooms on the route, if we can find one
+        route_rooms = None
+        if PathPlanner.use_room_graph and not isinstance(goal_shape, list):
+            room_graph = get_room_graph(robot.world.world_map)
+            route_rooms = room_graph.route_polygons((pose_x, pose_y),
+                                                    tuple(goal_shape.center[0:2,0]))
+
+        if stats:
+            stats.add_time('obstacles', obstacles_time)
+            stats.add_time('setup', time.time() - start_time - obstacles_time)
         return (start_node, goal_shape, robot_parts, bbox,
-                fat_obstacles, skinny_obstacles, doorway_list, need_grid_display)
+                obstacles, doorway_list, need_grid_display, route_rooms)
+
+    @staticmethod
+    def goal_object_shape(goal_object):
+        if isinstance(goal_object, (LightCubeObj,ChargerObj)):
+            return RRT.generate_cube_obstacle(goal_object)
+        elif isinstance(goal_object, CustomMarkerObj):
+            return RRT.generate_marker_obstacle(goal_object)
+        elif isinstance(goal_object, RoomObj):
+            return RRT.generate_room_obstacle(goal_object)
+        else:
+            raise ValueError("Can't convert path planner goal %s to shape." % goal_object)
 
     @staticmethod
     def do_planning(rrt_instance, start_node, goal_shape,
-                    fat_obstacles, skinny_obstacles, doorway_list, need_grid_display):
-        """Does the heavy lifting; may be called in a child process."""
+                    obstacles, doorway_list, need_grid_display, route_rooms=None,
+                    goal_fields=None, engine=None, cancel_token=None, progress=None,
+                    stats=None):
+        """Does the heavy lifting; may be called in a child process.
+        If route_rooms lists room vertices, the grid covers just those
+        rooms.  goal_fields is the goal field cache to use; it defaults to
+        PathPlanner.goal_fields.  If goal_shape is a list of shapes, we
+        plan to the nearest reachable one and the result gets a
+        goal_ranking attribute of (goal_index, cost_mm) pairs.  engine
+        overrides PathPlanner.search_engine; multi-goal planning always
+        uses the wavefront.  If cancel_token (a worker_pool.CancelToken)
+        is cancelled, or expires before a path is found, the result is a
+        PilotEvent with status PlanningAborted.  progress, if supplied, is
+        called with ProgressEvents carrying intermediate plans.  Phase
+        timings and counters are added to stats, a PlanStats, if supplied."""
+        if goal_fields is None:
+            goal_fields = PathPlanner.goal_fields
+        if engine is None:
+            engine = PathPlanner.search_engine
+        if engine not in ('wavefront', 'astar'):
+            raise ValueError('Unknown path planner search engine %r' % engine)
+        multi_goal = isinstance(goal_shape, list)
+        goal_shapes = goal_shape if multi_goal else [goal_shape]
 
         escape_options = (
                            # angle       distance(mm)
@@ -125,24 +463,42 @@ class PathPlanner():
                            (-pi/2,        70)
         )
 
-        rrt_instance.obstacles = skinny_obstacles
+        rrt_instance.obstacles = obstacles
         start_escape_move = None
+        if stats is None:
+            stats = PlanStats()
+        collision_checks = rrt_instance.collision_checks
+        smoothing_attempts = rrt_instance.smoothing_attempts
 
-        wf = WaveFront(bbox=rrt_instance.bbox)
-        for obstacle in fat_obstacles:
-            wf.add_obstacle(obstacle)
+        if route_rooms:
+            bbox = PathPlanner.region_bbox(route_rooms, start_node)
+        else:
+            bbox = rrt_instance.bbox
+        def aborted():
+            print('PathPlanner: planning aborted')
+            return PilotEvent(PlanningAborted, grid_display=None)
+        try:
+            base = PathPlanner.obstacle_grid(bbox, obstacles, region=route_rooms, stats=stats,
+                                             cancel_token=cancel_token)
+            wf = base.inflated(*PathPlanner.inflation())
+        except PlanningAborted:
+            return aborted()
 
+        escape_start_time = time.time()
         collider = rrt_instance.collides(start_node)
         if not collider:
             collider = wf.check_start_collides(start_node.x, start_node.y)
 
         if collider:
-          if collider.obstacle_id is goal_shape.obstacle_id:  # We're already at the goal
+          goal_ids = [shape.obstacle_id for shape in goal_shapes]
+          if collider.obstacle_id in goal_ids:  # We're already at the goal
             step = NavStep(NavStep.DRIVE, [RRTNode(x=start_node.x, y=start_node.y)])
             navplan = NavPlan([step])
             grid_display = None if not need_grid_display else wf.grid
-            result = (navplan, grid_display)
-            return DataEvent(result)
+            result = DataEvent((navplan, grid_display))
+            if multi_goal:
+                result.goal_ranking = [(goal_ids.index(collider.obstacle_id), 0)]
+            return result
           else:
             # Find an escape move from this collision condition
             q = start_node.q
@@ -167,47 +523,66 @@ class PathPlanner():
             if start_escape_move is None:
                 print('PathPlanner: Start collides!', collider)
                 return PilotEvent(StartCollides,collider=collider,grid_display=None)
+        stats.add_time('escape', time.time() - escape_start_time)
 
-        # Run the wavefront path planner
-        rrt_instance.obstacles = fat_obstacles
-        if goal_shape.obstacle_id.startswith('Room'):
-            offsets = [1, -25, -1]
-        else:
-            offsets = [None]
-        for i in range(len(offsets)):
-            offset = offsets[i]
-            if i > 0:
-                wf = WaveFront(bbox=rrt_instance.bbox)  # need a fresh grid
-            # obstacles come after the goal so they can overwrite goal pixels
-            for obstacle in fat_obstacles:
-                wf.add_obstacle(obstacle)
-            wf.set_goal_shape(goal_shape, offset, obstacle_inflation=PathPlanner.fat_obstacle_inflation)
-            wf_start = (start_node.x, start_node.y)
-            goal_found = wf.propagate(*wf_start)
-            if goal_found: break
-            print('Wavefront planning failed with offset', offset)
+        # Run the grid search.  If the room graph's route was no good
+        # (e.g., it missed a doorway), search the whole map instead.
+        wf_start = (start_node.x, start_node.y)
+        try:
+            (wf, coords_pairs, goal_ranking) = PathPlanner.grid_search(
+                base, goal_shape, engine, goal_fields, wf_start)
+            if coords_pairs is None and route_rooms:
+                print('PathPlanner: no path through rooms on the route; searching the whole map')
+                base = PathPlanner.obstacle_grid(rrt_instance.bbox, obstacles, stats=stats,
+                                                 cancel_token=cancel_token)
+                (wf, coords_pairs, goal_ranking) = PathPlanner.grid_search(
+                    base, goal_shape, engine, goal_fields, wf_start)
+        except PlanningAborted:
+            return aborted()
         grid_display = None if not need_grid_display else wf.grid
-        if goal_found is None:
+        if coords_pairs is None:
             print('PathPlanner wavefront: goal unreachable!')
-            return PilotEvent(GoalUnreachable, grid_display=grid_display)
+            result = PilotEvent(GoalUnreachable, grid_display=grid_display)
+            if multi_goal:
+                result.goal_ranking = []
+            return result
 
-        # Extract and smooth the path
-        coords_pairs = wf.extract(goal_found, wf_start)
+        # Smooth the path, posting the partly smoothed plan now and then,
+        # and keeping what we have if we run out of time.
+        smooth_start_time = time.time()
         rrt_instance.path = rrt_instance.coords_to_path(coords_pairs)
-        rrt_instance.obstacles = skinny_obstacles
-        #rrt_instance.obstacles = fat_obstacles
-        rrt_instance.smooth_path()
+        stats.count('path_nodes', len(rrt_instance.path))
+        if progress:
+            progress(ProgressEvent((PathPlanner.from_path(rrt_instance.path, doorway_list), None)))
+        last_progress = [time.time()]
+        def until(path):
+            if cancel_token and cancel_token.expired():
+                return True
+            if progress and time.time() - last_progress[0] > PathPlanner.progress_interval:
+                progress(ProgressEvent((PathPlanner.from_path(path, doorway_list), None)))
+                last_progress[0] = time.time()
+            return False
+        rrt_instance.smooth_path(until)
+        stats.add_time('smooth', time.time() - smooth_start_time)
+        stats.count('smoothing_attempts', rrt_instance.smoothing_attempts - smoothing_attempts)
+        if cancel_token and cancel_token.cancelled():
+            return aborted()
 
         # If the path ends in a collision according to the RRT, back off
+        backoff_start_time = time.time()
         while len(rrt_instance.path) > 2:
           last_node = rrt_instance.path[-1]
           if rrt_instance.collides(last_node):
             rrt_instance.path = rrt_instance.path[:-1]
           else:
             break
+        stats.add_time('backoff', time.time() - backoff_start_time)
+        stats.count('collision_checks', rrt_instance.collision_checks - collision_checks)
 
         # Construct the navigation plan
+        from_path_start_time = time.time()
         navplan = PathPlanner.from_path(rrt_instance.path, doorway_list)
+        stats.add_time('from_path', time.time() - from_path_start_time)
 
         # Insert the StartCollides escape move if there is one
         if start_escape_move:
@@ -227,44 +602,300 @@ class PathPlanner():
 
         # Return the navigation plan
         print('navplan=',navplan, '   steps=',navplan.steps)
-        result = (navplan, grid_display)
-        return DataEvent(result)
+        result = DataEvent((navplan, grid_display))
+        if multi_goal:
+            result.goal_ranking = goal_ranking
+        return result
 
     @staticmethod
-    def intersects_doorway(node1, node2, doorways):
-        for door in doorways:
-            p1 = (node1.x, node1.y)
-            p2 = (node2.x, node2.y)
-            p3 = door[1][0]
-            p4 = door[1][1]
-            result = segment_intersect_test(p1, p2, p3, p4)
-            #label = '**INTERSECTS**' if result else 'no_int:'
-            #print(label,door[0].id,' ( %.1f, %.1f )<=>( %.1f, %.1f )  vs  ( %.1f, %.1f )<=>( %.1f, %.1f )' % (p1+p2+p3+p4))
+    def grid_search(base, goal_shape, engine, goal_fields, wf_start):
+        """Search base, an obstacle grid, for a path from wf_start to the
+        goal, retrying with thinner obstacles if the goal is unreachable.
+        Returns (wf, path, goal_ranking); path is None if no goal can be
+        reached, and goal_ranking is None unless goal_shape is a list."""
+        multi_goal = isinstance(goal_shape, list)
+        (wf, coords_pairs, goal_ranking) = (base, None, None)
+        for scale in PathPlanner.inflation_retry_scales:
+            inflation = PathPlanner.inflation(scale)
+            if multi_goal:
+                try:
+                    (wf, coords_pairs, goal_ranking) = \
+                        PathPlanner.multi_goal_search(base, inflation, goal_shape, wf_start)
+                except StartCollides:  # inflated over the start
+                    (coords_pairs, goal_ranking) = (None, [])
+            else:
+                for offset in PathPlanner.goal_offsets(goal_shape):
+                    try:
+                        if engine == 'astar':
+                            (wf, coords_pairs) = PathPlanner.astar_search(
+                                base, inflation, goal_shape, offset, wf_start)
+                        else:
+                            found = None
+                            if PathPlanner.reuse_goal_fields:
+                                found = PathPlanner.goal_field_search(
+                                    goal_fields, base, inflation, goal_shape, offset, wf_start)
+                            (wf, coords_pairs) = found or PathPlanner.wavefront_search(
+                                base, inflation, goal_shape, offset, wf_start)
+                    except StartCollides:  # inflated over the start
+                        coords_pairs = None
+                    if coords_pairs: break
+                    print('Wavefront planning failed with offset', offset)
+            if coords_pairs: break
+            print('Wavefront planning failed with inflation', inflation)
+        return (wf, coords_pairs, goal_ranking)
+
+    @staticmethod
+    def inflation(scale=1):
+        "(obstacle, wall) growth in mm for WaveFront.inflated()."
+        return (PathPlanner.obstacle_growth * scale, PathPlanner.wall_growth * scale)
+
+    @staticmethod
+    def obstacle_grid(bbox, obstacles, square_size=5, pad=None, region=None, stats=None,
+                      cancel_token=None):
+        """Rasterize the skinny obstacles, confined to the region's rooms
+        if there is one; inflate with WaveFront.inflated().  The grid
+        records its timings in stats, and it and the grids made from it
+        check cancel_token as they go."""
+        start_time = time.time()
+        wf = WaveFront(square_size=square_size, bbox=bbox)
+        wf.cancel_token = cancel_token
+        for obstacle in obstacles:
+            wf.check_cancel()
+            wf.add_obstacle(obstacle, pad)
+        if region:
+            wf.restrict_to_region(region, PathPlanner.region_margin)
+        wf.stats = stats
+        if stats:
+            stats.add_time('raster', time.time() - start_time)
+        return wf
+
+    @staticmethod
+    def region_bbox(region, start_node):
+        "Bounding box of the region's rooms, grown by region_margin."
+        xs = [start_node.x] + [x for vertices in region for x in vertices[0]]
+        ys = [start_node.y] + [y for vertices in region for y in vertices[1]]
+        margin = PathPlanner.region_margin
+        return ((float(min(xs)) - margin, float(min(ys)) - margin),
+                (float(max(xs)) + margin, float(max(ys)) + margin))
+
+    @staticmethod
+    def goal_inflation(inflation):
+        """How far the goal's approach lanes must reach through its
+        inflation, in whole mm, since they are laid out with range()."""
+        return int(ceil(PathPlanner.skinny_obstacle_inflation + inflation[0]))
+
+    @staticmethod
+    def make_wavefront(base, inflation, goal_shape, offset):
+        wf = base.inflated(*inflation)
+        wf.set_goal_shape(goal_shape, offset, obstacle_inflation=PathPlanner.goal_inflation(inflation))
+        return wf
+
+    @staticmethod
+    def goal_offsets(goal_shape):
+        "Goal offsets to try in turn when the goal is a room."
+        if goal_shape.obstacle_id.startswith('Room'):
+            return [1, -25, -1]
+        else:
+            return [None]
+
+    @staticmethod
+    def wavefront_search(base, inflation, goal_shape, offset, wf_start):
+        """Run the wavefront from wf_start to the goal shape, using the
+        obstacle grid base grown by inflation.  Returns (wf, path), where
+        path is None if the goal is unreachable."""
+        if PathPlanner.coarse_to_fine:
+            result = PathPlanner.coarse_to_fine_search(base, inflation, goal_shape, offset, wf_start)
             if result:
-                return door[0]
-        return None
+                return result
+        wf = PathPlanner.make_wavefront(base, inflation, goal_shape, offset)
+        goal_found = wf.propagate(*wf_start)
+        if goal_found is None:
+            return (wf, None)
+        return (wf, wf.extract(goal_found, wf_start))
+
+    @staticmethod
+    def astar_search(base, inflation, goal_shape, offset, wf_start):
+        "Like wavefront_search(), but using WaveFront.astar()."
+        wf = PathPlanner.make_wavefront(base, inflation, goal_shape, offset)
+        goal_found = wf.astar(*wf_start)
+        if goal_found is None:
+            return (wf, None)
+        return (wf, wf.extract(goal_found, wf_start))
+
+    @staticmethod
+    def multi_goal_search(base, inflation, goal_shapes, wf_start):
+        """Mark all the goal shapes and propagate once from wf_start.
+        Returns (wf, path, ranking), where path leads to the nearest
+        reachable goal (or is None) and ranking lists (goal_index, cost_mm)
+        for every reachable goal, nearest first."""
+        wf = base.inflated(*inflation)
+        wf.set_goal_shapes(goal_shapes, obstacle_inflation=PathPlanner.goal_inflation(inflation))
+        results = wf.propagate_goals(*wf_start)
+        ranking = [(i, cost) for (i, cost, cell) in results]
+        if not results:
+            return (wf, None, ranking)
+        return (wf, wf.extract(results[0][2], wf_start), ranking)
+
+    @staticmethod
+    def goal_field_key(goal_shape, offset, obstacles, inflation, region=None):
+        """Fingerprint of everything a goal field depends on: the goal
+        shape and offset, the static obstacles, the inflation, and the
+        rooms the grid is confined to.  Shapes are fingerprinted in
+        packed form, since pickles of equal shapes can differ byte for
+        byte (e.g., after a trip through unpack_shapes or another process)."""
+        md5 = hashlib.md5()
+        for table in (pack_shapes([goal_shape]),
+                      pack_shapes(PathPlanner.static_obstacles(obstacles))):
+            md5.update(table_digest(table).encode())
+        md5.update(repr((offset, inflation)).encode())
+        for vertices in (region or ()):
+            md5.update(np.ascontiguousarray(vertices, dtype=float).tobytes())
+        return md5.hexdigest()
+
+    @staticmethod
+    def static_obstacles(obstacles):
+        prefixes = PathPlanner.static_obstacle_prefixes
+        return [obstacle for obstacle in obstacles if obstacle.obstacle_id.startswith(prefixes)]
+
+    @staticmethod
+    def goal_field_search(goal_fields, base, inflation, goal_shape, offset, wf_start):
+        """Descend a cached goal field from wf_start, building the field
+        first if the goal has been asked for often enough.  Returns
+        (wf, path) like wavefront_search(), or None if there is no field
+        or its path is blocked by an obstacle the field doesn't know
+        about, in which case the caller should search the usual way."""
+        obstacles = list(base.obstacles.values())
+        key = PathPlanner.goal_field_key(goal_shape, offset, obstacles, inflation, base.region)
+        requests = PathPlanner.goal_field_requests
+        requests[key] = requests.get(key, 0) + 1
+        requests.move_to_end(key)
+        while len(requests) > 4 * PathPlanner.goal_field_cache_size:
+            requests.popitem(last=False)
+        field = goal_fields.get(key, None)
+        path = None
+        if field is not None:
+            goal_fields.move_to_end(key)
+            path = PathPlanner.descend_field(field, base.stats, wf_start)
+            if path is None and field.bbox != base.bbox:
+                field = None  # the grid has grown since the field was built
+        if field is None:
+            if requests[key] < PathPlanner.goal_field_min_requests:
+                return None
+            field = PathPlanner.obstacle_grid(base.bbox, PathPlanner.static_obstacles(obstacles),
+                                              region=base.region, stats=base.stats,
+                                              cancel_token=base.cancel_token)
+            field = PathPlanner.make_wavefront(field, inflation, goal_shape, offset)
+            field.propagate_field()
+            PathPlanner.store_goal_field(goal_fields, key, field)
+            path = PathPlanner.descend_field(field, base.stats, wf_start)
+            if path is None:
+                # The field has fewer obstacles than base, so if it can't
+                # reach the start, no search on base can either.
+                return (field, None)
+        if path is None or PathPlanner.path_blocked(path, base, inflation, goal_shape, offset):
+            return None
+        if base.stats:
+            base.stats.count('goal_field_hits')
+        return (field, path)
+
+    @staticmethod
+    def descend_field(field, stats, wf_start):
+        field.stats = stats
+        try:
+            return field.descend(*wf_start) or None
+        finally:
+            field.stats = None
+
+    @staticmethod
+    def path_blocked(path, base, inflation, goal_shape, offset):
+        "True if a path from a goal field runs into any of base's obstacles."
+        wf = PathPlanner.make_wavefront(base, inflation, goal_shape, offset)
+        for (x,y) in path:
+            (gx,gy) = wf.coords_to_grid(x,y)
+            if gx is None:
+                return True
+            contents = wf.grid[gx,gy]
+            if contents < 0 and contents != wf.outside_marker:
+                return True
+        return False
+
+    @staticmethod
+    def store_goal_field(goal_fields, key, wf):
+        wf.cancel_token = None  # belongs to the plan that built the field
+        wf.stats = None
+        goal_fields[key] = wf
+        goal_fields.move_to_end(key)
+        while len(goal_fields) > PathPlanner.goal_field_cache_size:
+            goal_fields.popitem(last=False)
+
+    @staticmethod
+    def coarse_to_fine_search(base, inflation, goal_shape, offset, wf_start):
+        # Coarse pass over the whole bounding box.  Obstacles get no
+        # padding here so narrow doorways don't close up.
+        obstacles = list(base.obstacles.values())
+        coarse = PathPlanner.obstacle_grid(base.bbox, obstacles, region=base.region,
+                                           square_size=PathPlanner.coarse_square_size, pad=0,
+                                           stats=base.stats, cancel_token=base.cancel_token)
+        coarse = PathPlanner.make_wavefront(coarse, inflation, goal_shape, offset)
+        try:
+            coarse_goal = coarse.propagate(*wf_start)
+        except StartCollides:
+            return None
+        if coarse_goal is None:
+            return None
+        coarse_path = coarse.extract(coarse_goal, wf_start)
+        # Fine pass over the corridor's bounding box only.
+        half_width = PathPlanner.corridor_half_width
+        xs = [x for (x,y) in coarse_path]
+        ys = [y for (x,y) in coarse_path]
+        corridor_bbox = ((min(xs) - half_width, min(ys) - half_width),
+                         (max(xs) + half_width, max(ys) + half_width))
+        fine = PathPlanner.obstacle_grid(corridor_bbox, obstacles, stats=base.stats,
+                                         cancel_token=base.cancel_token).inflated(*inflation)
+        fine.warn_outside = False
+        fine.restrict_to_corridor(coarse_path, half_width)
+        fine.set_goal_shape(goal_shape, offset, obstacle_inflation=PathPlanner.goal_inflation(inflation))
+        try:
+            goal_found = fine.propagate(*wf_start)
+        except StartCollides:
+            return None
+        if goal_found is None:
+            return None
+        return (fine, fine.extract(goal_found, wf_start))
+
+    @staticmethod
+    def doorway_crossing(path, doorways):
+        """(i, door) for the first leg of the path, from path[i] to
+        path[i+1], that crosses a doorway threshold, or None.  All legs
+        are tested against all doorways in one batch."""
+        if not doorways or len(path) < 2:
+            return None
+        crossing = first_crossing([(node.x, node.y) for node in path],
+                                  [door[1][0] for door in doorways],
+                                  [door[1][1] for door in doorways])
+        if crossing is None:
+            return None
+        (i, j) = crossing
+        return (i, doorways[j][0])
+
+    @staticmethod
+    def intersects_doorway(node1, node2, doorways):
+        crossing = PathPlanner.doorway_crossing([node1, node2], doorways)
+        return crossing[1] if crossing else None
 
     @staticmethod
     def from_path(path, doorways):
-        # Consider each path segment (defined by start and end
-        # RRTNodes) and see if it crosses a doorway.
-        door = None
-        i = 0  # in case len(path) is 1 and we skip the for loop
-        pt1 = path[i]
-        for i in range(1, len(path)):
-            pt2 = path[i]
-            door = PathPlanner.intersects_doorway(pt1,pt2,doorways)
-            if door:
-                i -= 1
-                break
-            else:
-                pt1 = pt2
+        # Find the first path segment (defined by start and end
+        # RRTNodes) that crosses a doorway.
+        crossing = PathPlanner.doorway_crossing(path, doorways)
 
         # If no doorway, we're good to go
-        if door is None:
+        if crossing is None:
             step = NavStep(NavStep.DRIVE, path)
             plan = NavPlan([step])
             return plan
+        (i, door) = crossing
+        pt1 = path[i]
 
         # Truncate the path at the doorway, and ajust to make sure
         # we're outside the approach gate.
@@ -295,34 +926,128 @@ class PathPlanner():
 # This code is for running the path planner in a child process.
 
 class PathPlannerProcess(LaunchProcess):
+    def __init__(self, engine=None, time_budget=None):
+        super().__init__()
+        self.engine = engine
+        self.time_budget = time_budget  # defaults to PathPlanner.time_budget
+        self.cancel_token = None  # for the job launched by this activation
+        self.token_job_id = None
+
     def start(self, event=None):
+        if self.running: return
         if not isinstance(event,DataEvent):
             raise ValueError('PathPlanner node must be invoked with a DataEvent for the goal.')
         goal_object = event.data
-        if not isinstance(goal_object, WorldObject):
-            raise ValueError('Path planner goal %s is not a WorldObject' % goal_object)
+        goals = goal_object if isinstance(goal_object, (list,tuple)) else [goal_object]
+        for goal in goals:
+            if not isinstance(goal, WorldObject):
+                raise ValueError('Path planner goal %s is not a WorldObject' % goal)
         self.goal_object = goal_object
-        self.print_trace_message('started:', 'goal=%s' % goal_object)
-        super().start(event)  # will call create_process
-
-    def create_process(self, reply_token):
+        self.print_trace_message('started:', 'goal=%s' % (goal_object,))
         use_doorways = True   # assume we're running on the robot
+        self.job_start_time = time.time()
+        self.stats = PlanStats()
+        self.problem = PathPlanner.setup_problem(goal_object, self.robot, use_doorways, self.stats)
+        start_node = self.problem[0]
+        self.plan_cache_key = PathPlanner.plan_cache_key(start_node, goal_object, self.robot,
+                                                         use_doorways, self.engine)
+        result = PathPlanner.cached_plan(self.plan_cache_key, self.robot.world.rrt,
+                                         start_node, self.stats)
+        if result is None:
+            super().start(event)  # will call create_job or create_process
+            return
+        # Cache hit: post the plan as if the child process had returned it.
+        StateNode.start(self, event)
+        self.job_id = self.robot.erouter.add_process_node(self)  # so stop() can remove it as usual
+        self.stats.add_time('total', time.time() - self.job_start_time)
+        result.stats = self.stats
+        PathPlanner.record_stats(self.stats)
+        result = PathPlanner.unpack_goal_ranking(result, self.goal_object)
+        result.source = self
+        self.robot.erouter.post(result)
+
+    def job_queue(self):
+        "Plans go to the shared planning service if there is one."
+        return getattr(self.robot, 'plan_service', None) or super().job_queue()
+
+    def create_job(self):
         (start_node, goal_shape, robot_parts, bbox,
-         fat_obstacles, skinny_obstacles, doorway_list, need_grid_display) = \
-            PathPlanner.setup_problem(self.goal_object, self.robot, use_doorways)
-        p = Process(target=self.__class__.process_workhorse,
-                    args = [reply_token,
-                            start_node, goal_shape, robot_parts, bbox,
-                            fat_obstacles, skinny_obstacles, doorway_list,
-                            need_grid_display])
+         obstacles, doorway_list, need_grid_display, route_rooms) = self.problem
+        time_budget = self.time_budget or PathPlanner.time_budget
+        self.cancel_token = CancelToken(time.time() + time_budget if time_budget else None)
+        self.token_job_id = self.job_id
+        # Shapes travel as packed tables; see rrt_shapes.pack_shapes.
+        # Goal fields don't travel at all: each worker (or the planning
+        # service) keeps its own PathPlanner.goal_fields between jobs.
+        args = [start_node, goal_shape, pack_shapes(robot_parts), bbox,
+                pack_shapes(obstacles), doorway_list, need_grid_display, route_rooms,
+                self.engine, self.cancel_token]
+        return (self.__class__.process_workhorse, args)
+
+    def create_process(self, reply_token):
+        (workhorse, args) = self.create_job()
+        p = Process(target=workhorse, args=[reply_token] + args)
         return p
 
     @staticmethod
     def process_workhorse(reply_token, start_node, goal_shape, robot_parts, bbox,
-                          fat_obstacles, skinny_obstacles, doorway_list, need_grid_display): 
+                          obstacles, doorway_list, need_grid_display, route_rooms,
+                          engine, cancel_token):
+        robot_parts = unpack_shapes(robot_parts)
+        obstacles = unpack_shapes(obstacles)
         rrt_instance = RRT(robot_parts=robot_parts, bbox=bbox)
+        start_time = time.time()
+        stats = PlanStats()
         result = \
             PathPlanner.do_planning(rrt_instance, start_node, goal_shape,
-                                    fat_obstacles, skinny_obstacles, doorway_list,
-                                    need_grid_display)
+                                    obstacles, doorway_list, need_grid_display, route_rooms,
+                                    PathPlanner.goal_fields, engine, cancel_token,
+                                    lambda event: __class__.post_event(reply_token, event),
+                                    stats)
+        stats.add_time('total', time.time() - start_time)
+        result.stats = stats
+        # The grid display goes back through shared memory, not the queue.
+        __class__.map_grid_display(result, SharedArray)
         __class__.post_event(reply_token, result)
+
+    @staticmethod
+    def map_grid_display(event, fn):
+        "Replace the grid display carried by a planner result with fn(grid)."
+        if isinstance(event, DataEvent):
+            (navplan, grid_display) = event.data
+            if grid_display is not None:
+                event.data = (navplan, fn(grid_display))
+        elif isinstance(event, PilotEvent):
+            grid_display = event.args.get('grid_display')
+            if grid_display is not None:
+                event.args['grid_display'] = fn(grid_display)
+
+    def release_token(self, job_id):
+        "Cancel job_id's token, or free it if the job is done."
+        if self.cancel_token and self.token_job_id == job_id:
+            self.cancel_token.cancel()
+            self.cancel_token = None
+            self.token_job_id = None
+            return True
+        return False
+
+    def stop(self):
+        if self.release_token(self.job_id):  # abandon the plan if it's still running
+            queue = self.job_queue()
+            if hasattr(queue, 'cancel'):
+                queue.cancel(self.job_id)
+        super().stop()
+
+    def unpack_process_event(self, event):
+        # The event router only passes us replies from our current job.
+        if isinstance(event, ProgressEvent):
+            return event
+        self.release_token(self.job_id)  # the plan is finished
+        self.map_grid_display(event, lambda handle: handle.fetch())
+        PathPlanner.store_plan(self.plan_cache_key, event)
+        if hasattr(event, 'stats'):  # add the setup times from create_job
+            self.stats.merge(event.stats)
+            self.stats.add_time('round_trip', time.time() - self.job_start_time)
+            event.stats = self.stats
+            PathPlanner.record_stats(self.stats)
+        return PathPlanner.unpack_goal_ranking(event, self.goal_object)
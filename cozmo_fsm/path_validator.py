@@ -0,0 +1,158 @@
+"""
+Incremental validation of a navigation plan in progress.
+
+When a cube is seen or a wall is moved while the robot is following a
+plan, we only need to know whether that particular change blocks the
+part of the path still ahead.  PathValidator remembers the world map's
+object signatures from when it was created; each check() looks only at
+objects whose signature has changed since then, screens their obstacle
+shapes against bounding boxes around the remaining legs, and runs the
+collision test just for the legs whose boxes they touch.  When the map
+version hasn't changed, check() returns at once.
+
+The ValidatePath node polls a PathValidator while the plan executes and
+posts a PilotEvent with status PathBlocked when a change does block the
+path, so the pilot can replan only when it has to.
+"""
+
+import time
+import numpy as np
+from math import sqrt
+
+from .base import StateNode
+from .events import DataEvent, PilotEvent
+from .pilot0 import NavPlan
+from .rrt import RRT, PathBlocked
+from .path_planner import PathPlanner
+
+class PathValidator():
+    def __init__(self, robot, navplan):
+        self.robot = robot
+        self.world_map = robot.world.world_map
+        self.navplan = navplan
+        self.version = self.world_map.version
+        self.signatures = dict(self.world_map.object_signatures)
+        self.legs = PathPlanner.plan_legs(navplan)
+        self.leg_index = 0  # legs before this one have been driven
+        rrt = robot.world.rrt
+        self.checker = RRT(robot_parts=rrt.robot_parts, bbox=rrt.bbox)
+        # Broad phase: each leg's bounding box, grown by the robot's reach.
+        reach = self.robot_reach(rrt.robot_parts)
+        boxes = [(min(a.x,b.x), min(a.y,b.y), max(a.x,b.x), max(a.y,b.y)) for (a,b) in self.legs]
+        self.leg_boxes = np.array(boxes, dtype=float).reshape(-1,4) + [-reach, -reach, reach, reach]
+        self.checks = 0
+        self.narrow_checks = 0
+        self.check_time = 0
+
+    def __repr__(self):
+        return '<PathValidator: leg %d of %d, %d checks in %.1f ms>' % \
+               (self.leg_index, len(self.legs), self.checks, self.check_time*1000)
+
+    @staticmethod
+    def robot_reach(robot_parts):
+        "Distance from the robot's origin to the farthest corner of any part's bounding box."
+        reach = 0
+        for part in robot_parts:
+            ((xmin,ymin), (xmax,ymax)) = part.get_bounding_box()
+            reach = max(reach, sqrt(max(xmin*xmin, xmax*xmax) + max(ymin*ymin, ymax*ymax)))
+        return reach
+
+    def advance(self, x, y):
+        """Note the robot's progress: the leg nearest (x,y), looking from
+        the current leg forward, becomes the current leg."""
+        if self.leg_index >= len(self.legs):
+            return
+        legs = self.legs[self.leg_index:]
+        a = np.array([(a.x, a.y) for (a,b) in legs])
+        d = np.array([(b.x - a.x, b.y - a.y) for (a,b) in legs])
+        p = np.array([x, y]) - a
+        lengthsq = np.maximum((d*d).sum(1), 1e-9)
+        t = np.clip((p*d).sum(1) / lengthsq, 0, 1)
+        distsq = ((p - t[:,None]*d)**2).sum(1)
+        self.leg_index += int(np.argmin(distsq))
+
+    def changed_objects(self):
+        "Objects that are new or whose signature changed since the last check."
+        signatures = self.world_map.object_signatures
+        changed = [self.world_map.objects[key] for (key, signature) in signatures.items()
+                   if key in self.world_map.objects and self.signatures.get(key) != signature]
+        self.signatures = dict(signatures)
+        self.version = self.world_map.version
+        return changed
+
+    def obstacle_shapes(self, objects):
+        rrt = self.robot.world.rrt
+        shapes = []
+        for obj in objects:
+            if not obj.is_obstacle or obj.pose_confidence < 0 or self.robot.carrying is obj:
+                continue
+            shapes += rrt.generate_object_obstacles(obj, PathPlanner.skinny_obstacle_inflation,
+                                                    PathPlanner.skinny_wall_inflation,
+                                                    PathPlanner.skinny_doorway_adjustment)
+        return shapes
+
+    def check(self):
+        """Check the remaining legs against whatever changed in the world
+        map since the last check.  Returns (obstacle_id, leg_index) for
+        the first leg that is now blocked, or None."""
+        if self.world_map.version == self.version:
+            return None
+        start_time = time.time()
+        self.checks += 1
+        result = None
+        shapes = self.obstacle_shapes(self.changed_objects())
+        boxes = self.leg_boxes[self.leg_index:]
+        if shapes and len(boxes) > 0:
+            # Broad phase: which remaining legs could each shape touch?
+            (candidates, near_shapes) = (np.zeros(len(boxes), dtype=bool), [])
+            for shape in shapes:
+                ((xmin,ymin), (xmax,ymax)) = shape.get_bounding_box()
+                overlaps = (boxes[:,0] <= xmax) & (boxes[:,2] >= xmin) & \
+                           (boxes[:,1] <= ymax) & (boxes[:,3] >= ymin)
+                if overlaps.any():
+                    candidates |= overlaps
+                    near_shapes.append(shape)
+            # Narrow phase: pose-by-pose collision test on those legs only.
+            leg_numbers = np.flatnonzero(candidates) + self.leg_index
+            if len(leg_numbers) > 0:
+                self.narrow_checks += 1
+                self.checker.obstacles = near_shapes
+                (xs, ys, qs, indices) = PathPlanner.leg_poses(
+                    [self.legs[i] for i in leg_numbers], self.checker.step_size)
+                hits = self.checker.collides_poses(xs, ys, qs)
+                if hits.any():
+                    k = np.argmax(hits)
+                    leg = int(leg_numbers[indices[k]])
+                    for shape in near_shapes:
+                        self.checker.obstacles = [shape]
+                        if self.checker.collides_poses(xs[k], ys[k], qs[k])[0]:
+                            result = (shape.obstacle_id, leg)
+                            break
+        self.check_time += time.time() - start_time
+        return result
+
+
+class ValidatePath(StateNode):
+    """Start this node with a DataEvent holding the NavPlan being
+    executed.  It watches the world map while the plan runs and posts a
+    PilotEvent with status PathBlocked, and args obstacle_id and leg,
+    if a change to the map blocks the rest of the path."""
+    def __init__(self, polling_interval=0.1):
+        super().__init__()
+        self.polling_interval = polling_interval
+        self.validator = None
+
+    def start(self, event=None):
+        if not (isinstance(event, DataEvent) and isinstance(event.data, NavPlan)):
+            raise ValueError('ValidatePath must be started with a DataEvent holding a NavPlan', event)
+        self.validator = PathValidator(self.robot, event.data)
+        super().start(event)
+
+    def poll(self):
+        (x, y, theta) = self.robot.world.particle_filter.pose
+        self.validator.advance(x, y)
+        conflict = self.validator.check()
+        if conflict:
+            (obstacle_id, leg) = conflict
+            print('ValidatePath: %s now blocks leg %d of the path' % (obstacle_id, leg))
+            self.post_event(PilotEvent(PathBlocked, obstacle_id=obstacle_id, leg=leg))
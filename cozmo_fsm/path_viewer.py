@@ -281,6 +281,8 @@ class PathViewer():
                         self.draw_rectangle(center=c, width=w, height=h, color=(0, 1, 0)) # green for goal
                     elif  grid[x,y] == 1:
                         self.draw_rectangle(center=c, width=w, height=h, color=(1, 1, 0)) # yellow for start
+                    elif  grid[x,y] == WaveFront.outside_marker:
+                        pass  # outside the coarse-to-fine corridor
                     elif  grid[x,y] < 0:
                         self.draw_rectangle(center=c, width=w, height=h, color=(1, 0, 0)) # red for obstacle
                     else:
@@ -7,7 +7,7 @@ from .base import *
 from .rrt import *
 #from .nodes import ParentFails, ParentCompletes, DriveArc, DriveContinuous, Forward, Turn
 from .nodes import *
-from .events import PilotEvent
+from .events import PilotEvent, ProgressEvent
 #from .transitions import CompletionTrans, FailureTrans, SuccessTrans, DataTrans, NullTrans
 from .transitions import *
 from .cozmo_kin import wheelbase, center_of_rotation_offset
@@ -59,6 +59,16 @@ class PilotBase(StateNode):
               return
           self.post_event(DataEvent(self.parent.object))
 
+    class PlanPath(PathPlannerProcess):
+        """Path planner that shows each partial plan (the unsmoothed path,
+        then better ones) in the path viewer while smoothing goes on."""
+        def unpack_process_event(self, event):
+            event = super().unpack_process_event(event)
+            if isinstance(event, ProgressEvent):
+                (navplan, grid_display) = event.data
+                self.robot.world.rrt.draw_path = navplan.extract_path()
+            return event
+
     class ReceivePlan(StateNode):
         def start(self, event=None):
             super().start(event)
@@ -232,7 +242,7 @@ class PilotToObject(PilotBase):
     
             launch: self.SendObject() =D=> planner
     
-            planner: PathPlannerProcess() =D=> recv
+            planner: self.PlanPath() =D=> recv
             planner =PILOT=> ParentPilotEvent() =N=> Print('Path planner failed')
     
             recv: self.ReceivePlan() =D=> exec
@@ -246,10 +256,10 @@ class PilotToObject(PilotBase):
             check =F=> planner
         """
         
-        # Code generated by genfsm on Mon Apr 27 18:09:17 2020:
+        # Code generated by genfsm on Mon Oct 19 08:48:22 2026:
         
         launch = self.SendObject() .set_name("launch") .set_parent(self)
-        planner = PathPlannerProcess() .set_name("planner") .set_parent(self)
+        planner = self.PlanPath() .set_name("planner") .set_parent(self)
         parentpilotevent1 = ParentPilotEvent() .set_name("parentpilotevent1") .set_parent(self)
         print1 = Print('Path planner failed') .set_name("print1") .set_parent(self)
         recv = self.ReceivePlan() .set_name("recv") .set_parent(self)
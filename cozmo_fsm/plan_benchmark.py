@@ -0,0 +1,213 @@
+"""
+Offline benchmark for the path planners.
+
+Runs a corpus of planning problems against a SimRobot, so no robot is
+needed, and reports planning time, iterations, path length, and success
+rate per engine.  Engines are 'wavefront' and 'astar' (PathPlanner,
+for problems whose goal is a world map object) and 'rrt' (RRT.plan_path,
+for problems whose goal is a pose).
+
+The corpus is a JSON file; see plan_benchmark.json for the format.
+Layouts place walls from wall_defs by spec id (e.g., 'Wall-1'), plus
+cubes, the charger, and rooms.  Angles are in degrees.
+
+Usage:
+    python -m cozmo_fsm.plan_benchmark [corpus.json] [--engines wavefront,astar,rrt]
+                                       [--repeat N] [--json results.json]
+                                       [--compare old_results.json]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import time
+from math import pi, sqrt
+from statistics import median
+
+import numpy as np
+
+from .sim_robot import SimRobot
+from .worldmap import LightCubeObj, ChargerObj, RoomObj, WallObj, wall_marker_dict
+from .rrt import RRTNode, RRTException
+from .path_planner import PathPlanner
+from .events import DataEvent
+from .pilot0 import NavStep
+from . import wall_defs  # registers the wall specs in wall_marker_dict
+
+default_corpus = os.path.join(os.path.dirname(__file__), 'plan_benchmark.json')
+
+engines = ('wavefront', 'astar', 'rrt')
+
+def load_corpus(filename=default_corpus):
+    with open(filename) as f:
+        return json.load(f)
+
+def build_world(robot, layout):
+    "Replace the world map's contents with the layout's objects."
+    world_map = robot.world.world_map
+    world_map.clear()
+    for spec in layout.get('walls', []):
+        wall = WallObj(wall_spec=wall_marker_dict[spec['spec']],
+                       x=spec['x'], y=spec['y'], theta=spec['theta']/180*pi)
+        world_map.objects[wall.id] = wall
+        wall.make_doorways(world_map)
+    for spec in layout.get('cubes', []):
+        cube = LightCubeObj(None, id=spec['id'], x=spec['x'], y=spec['y'],
+                            theta=spec['theta']/180*pi)
+        world_map.objects[cube.id] = cube
+    spec = layout.get('charger')
+    if spec:
+        charger = ChargerObj(None, x=spec['x'], y=spec['y'], theta=spec['theta']/180*pi)
+        world_map.objects[charger.id] = charger
+    for spec in layout.get('rooms', []):
+        xy = np.array(spec['points'], dtype=float).T
+        points = np.vstack([xy, np.zeros(xy.shape[1]), np.ones(xy.shape[1])])
+        room = RoomObj(spec['name'], points, door_ids=spec.get('door_ids', []))
+        world_map.objects[room.id] = room
+    for obj in world_map.objects.values():
+        obj.pose_confidence = +1
+    world_map.version += 1
+
+def set_pose(robot, pose):
+    (x, y, theta) = pose
+    robot.world.particle_filter.pose = (x, y, theta/180*pi)
+
+def path_length(nodes):
+    "Polyline length; arcs are measured by their chords."
+    return sum(sqrt((b.x-a.x)**2 + (b.y-a.y)**2) for (a,b) in zip(nodes, nodes[1:]))
+
+def applies(problem, engine):
+    if engine == 'rrt':
+        return 'goal_pose' in problem
+    else:
+        return 'goal' in problem
+
+def run_problem(robot, problem, engine, verbose=False):
+    """Solve one problem with one engine.  Returns a record of the run."""
+    set_pose(robot, problem['start'])
+    random.seed(problem['name'])
+    PathPlanner.goal_fields.clear()  # measure cold plans
+    PathPlanner.goal_field_requests.clear()
+    PathPlanner.plan_cache.clear()
+    output = None if verbose else io.StringIO()
+    with contextlib.redirect_stdout(output) if output else contextlib.nullcontext():
+        start_time = time.time()
+        if engine == 'rrt':
+            (x, y, theta) = problem['goal_pose']
+            goal = RRTNode(x=x, y=y, q=theta/180*pi)
+            (sx, sy, stheta) = problem['start']
+            start = RRTNode(x=sx, y=sy, q=stheta/180*pi)
+            rrt = robot.world.rrt
+            try:
+                (treeA, treeB, path) = rrt.plan_path(start, goal)
+                success = True
+            except RRTException:
+                path = []
+                success = False
+            elapsed = time.time() - start_time
+            iterations = rrt.last_iterations
+        else:
+            goal = robot.world.world_map.objects[problem['goal']]
+            result = PathPlanner.plan_path_this_process(goal, robot, engine=engine)
+            elapsed = time.time() - start_time
+            success = isinstance(result, DataEvent)
+            path = []
+            if success:
+                (navplan, grid_display) = result.data
+                for step in navplan.steps:
+                    if step.type != NavStep.DOORPASS:
+                        path = path + list(step.param)
+            iterations = result.stats.counters.get('cells_expanded', 0)
+    return dict(problem = problem['name'],
+                engine = engine,
+                success = success,
+                time = elapsed,
+                iterations = iterations,
+                path_length = path_length(path) if success else None)
+
+def summarize(records):
+    "Per-engine summary of a list of run records."
+    summary = dict()
+    for engine in engines:
+        runs = [r for r in records if r['engine'] == engine]
+        if not runs:
+            continue
+        solved = [r for r in runs if r['success']]
+        summary[engine] = dict(
+            runs = len(runs),
+            success_rate = len(solved) / len(runs),
+            median_time = median(r['time'] for r in runs),
+            total_time = sum(r['time'] for r in runs),
+            mean_iterations = sum(r['iterations'] or 0 for r in runs) / len(runs),
+            mean_path_length = sum(r['path_length'] for r in solved) / len(solved) if solved else None)
+    return summary
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def run_corpus(corpus, engine_list=engines, repeat=1, verbose=False):
+    robot = SimRobot()
+    records = []
+    for problem in corpus['problems']:
+        build_world(robot, corpus['layouts'][problem['layout']])
+        for engine in engine_list:
+            if not applies(problem, engine):
+                continue
+            for i in range(repeat):
+                records.append(run_problem(robot, problem, engine, verbose))
+    return dict(commit = git_commit(),
+                records = records,
+                summary = summarize(records))
+
+def show_results(results, baseline=None):
+    print('%-18s %-10s %7s %8s %10s %10s' %
+          ('problem', 'engine', 'success', 'ms', 'iterations', 'length'))
+    for r in results['records']:
+        length = '%10.0f' % r['path_length'] if r['path_length'] is not None else '%10s' % '-'
+        print('%-18s %-10s %7s %8.1f %10d %s' %
+              (r['problem'], r['engine'], r['success'], r['time']*1000,
+               r['iterations'] or 0, length))
+    print()
+    for (engine, s) in results['summary'].items():
+        line = '%-10s %d runs, %3.0f%% solved, median %.1f ms, total %.1f ms' % \
+               (engine, s['runs'], s['success_rate']*100, s['median_time']*1000, s['total_time']*1000)
+        old = baseline and baseline['summary'].get(engine)
+        if old:
+            line += ' (%.2fx of %s)' % (s['total_time'] / old['total_time'], baseline['commit'])
+        print(line)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the path planners.')
+    parser.add_argument('corpus', nargs='?', default=default_corpus)
+    parser.add_argument('--engines', default=','.join(engines),
+                        help='comma-separated list of engines')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--compare', help='results file from an earlier run')
+    parser.add_argument('--verbose', action='store_true', help="show the planners' output")
+    args = parser.parse_args(args)
+    engine_list = args.engines.split(',')
+    for engine in engine_list:
+        if engine not in engines:
+            parser.error('Unknown engine %r' % engine)
+    results = run_corpus(load_corpus(args.corpus), engine_list, args.repeat, args.verbose)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    show_results(results, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
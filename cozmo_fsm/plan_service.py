@@ -0,0 +1,306 @@
+"""
+Path planning service shared by several robots on one host.
+
+Normally every robot's program plans in its own worker processes, with
+its own copy of the obstacles and its own goal field cache.  When
+several robots share an arena (and a shared map), the service lets them
+share one planner instead.  Start it once:
+
+    python -m cozmo_fsm.plan_service [--address /tmp/cozmo_fsm_plan_service]
+
+then pass plan_service=True (or the address) to StateMachineProgram.
+PathPlannerProcess nodes send their jobs to the service (the client is
+their job_queue, in place of the worker pool), which keeps a single
+cache of unpacked obstacle tables and goal fields.  Requests that
+arrive together are handled as a batch: requests with the same obstacle
+table share one unpacked copy, and identical requests are planned once.
+Results come back tagged with each request's job id and are fed into
+that robot's interprocess queue, so the requesting node sees them just
+as it would see results from a worker process.
+
+The service plans on a single dispatcher thread, one group at a time.
+Threads would gain little, since planning holds the interpreter lock
+for much of its time, and the goal field cache is not thread safe.
+Batching and the shared caches are where the service saves work; for
+more planning throughput, run one service per group of robots.
+"""
+
+import argparse
+import copy
+import os
+import queue
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from multiprocessing.managers import BaseManager
+
+from .events import PilotEvent, FailureEvent
+from .rrt import RRT
+from .rrt_shapes import pack_shapes, unpack_shapes, table_digest
+from .path_planner import PathPlanner, PathPlannerProcess, PlanStats
+from .worker_pool import SharedArray
+
+default_address = '/tmp/cozmo_fsm_plan_service'
+default_authkey = b'cozmo_fsm'
+
+
+class PlanServiceManager(BaseManager):
+    pass
+
+
+class ServiceToken():
+    """Stands in for the requesters' CancelTokens inside the service.  A
+    plan shared by several requests is abandoned only when all of them
+    have been cancelled; its deadline is the latest of theirs."""
+    def __init__(self, service, request_ids, deadlines):
+        self.service = service
+        self.request_ids = request_ids
+        self.deadline = None if None in deadlines else max(deadlines)
+
+    def cancelled(self):
+        return all(request_id in self.service.cancelled for request_id in self.request_ids)
+
+    def expired(self):
+        return (self.deadline is not None and time.time() > self.deadline) or \
+               self.cancelled()
+
+
+class PlanService():
+    """Runs in the service process.  Clients call connect(), submit(),
+    and cancel() through a PlanServiceManager proxy.  A request is
+    named by (client_id, job_id); job ids come from the client's event
+    router and are never reused, so each request has its own name."""
+    batch_window = 0.005  # seconds to wait for more requests to batch
+    max_batch = 16
+    table_cache_size = 16
+
+    def __init__(self):
+        self.requests = queue.Queue()
+        self.reply_queues = dict()  # client_id -> queue.Queue
+        self.pending = set()        # (client_id, job_id) of requests not yet answered
+        self.cancelled = set()      # the pending requests that have been cancelled
+        self.next_client_id = 1
+        self.tables = OrderedDict() # table digest -> unpacked shapes
+        self.lock = threading.Lock()
+        self.stats = dict(requests=0, batches=0, plans=0, shared_plans=0,
+                          table_hits=0, table_misses=0)
+
+    def connect(self):
+        "Register a client; returns its client id."
+        with self.lock:
+            client_id = self.next_client_id
+            self.next_client_id += 1
+            self.reply_queues[client_id] = queue.Queue()
+        return client_id
+
+    def disconnect(self, client_id):
+        with self.lock:
+            self.reply_queues.pop(client_id, None)
+            for request_id in [r for r in self.pending if r[0] == client_id]:
+                self.cancelled.add(request_id)
+
+    def reply_queue(self, client_id):
+        return self.reply_queues[client_id]
+
+    def submit(self, client_id, job_id, args):
+        "Queue a plan; args are as made by PathPlannerProcess.create_job."
+        with self.lock:
+            self.stats['requests'] += 1
+            self.pending.add((client_id, job_id))
+        self.requests.put((client_id, job_id, args))
+
+    def cancel(self, client_id, job_id):
+        "Cancel a request.  A request that has been answered is already gone."
+        with self.lock:
+            if (client_id, job_id) in self.pending:
+                self.cancelled.add((client_id, job_id))
+
+    def finish(self, request_id):
+        "Forget a request once it has been answered or dropped."
+        with self.lock:
+            self.pending.discard(request_id)
+            self.cancelled.discard(request_id)
+
+    def get_stats(self):
+        return dict(self.stats, clients=len(self.reply_queues),
+                    cached_tables=len(self.tables),
+                    cached_goal_fields=len(PathPlanner.goal_fields))
+
+    def post(self, request_id, event):
+        (client_id, job_id) = request_id
+        replies = self.reply_queues.get(client_id)
+        if replies is not None:
+            replies.put((job_id, event))
+
+    def shapes(self, table):
+        "Unpacked shapes for a packed table, shared by every request that uses it."
+        key = table_digest(table)
+        shapes = self.tables.get(key)
+        if shapes is None:
+            self.stats['table_misses'] += 1
+            shapes = unpack_shapes(table)
+            self.tables[key] = shapes
+            while len(self.tables) > self.table_cache_size:
+                self.tables.popitem(last=False)
+        else:
+            self.stats['table_hits'] += 1
+        self.tables.move_to_end(key)
+        return (key, shapes)
+
+    def run(self):
+        "Dispatcher loop: collect a batch of requests, then plan it."
+        while True:
+            batch = [self.requests.get()]
+            stop_time = time.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.requests.get(timeout=max(0, stop_time - time.time())))
+                except queue.Empty:
+                    break
+            self.stats['batches'] += 1
+            self.plan_batch(batch)
+
+    def plan_batch(self, batch):
+        """Group identical requests, then plan each group, with groups
+        that share an obstacle table planned back to back."""
+        groups = OrderedDict()
+        for (client_id, job_id, args) in batch:
+            request_id = (client_id, job_id)
+            if request_id in self.cancelled:
+                self.finish(request_id)
+                continue
+            (start_node, goal_shape, robot_parts, bbox, obstacles, doorway_list,
+             need_grid_display, route_rooms, engine, cancel_token) = args
+            (obstacle_key, obstacles) = self.shapes(obstacles)
+            (parts_key, robot_parts) = self.shapes(robot_parts)
+            key = (obstacle_key, parts_key, repr(start_node), table_digest(pack_shapes(
+                       goal_shape if isinstance(goal_shape, list) else [goal_shape])),
+                   repr(bbox), repr(doorway_list), need_grid_display, repr(route_rooms), engine)
+            problem = (start_node, goal_shape, robot_parts, bbox, obstacles,
+                       doorway_list, need_grid_display, route_rooms, engine)
+            deadline = cancel_token.deadline if cancel_token else None
+            if key in groups:
+                groups[key][1].append(request_id)
+                groups[key][2].append(deadline)
+            else:
+                groups[key] = (problem, [request_id], [deadline])
+        for (key, (problem, request_ids, deadlines)) in \
+                sorted(groups.items(), key=lambda item: item[0][0]):
+            self.stats['plans'] += 1
+            if len(request_ids) > 1:
+                self.stats['shared_plans'] += 1
+            token = ServiceToken(self, request_ids, deadlines)
+            try:
+                result = self.plan(problem, request_ids, token)
+            except Exception as e:
+                traceback.print_exc()
+                result = FailureEvent(repr(e))
+            for request_id in request_ids:
+                self.finish(request_id)
+                self.post(request_id, self.copy_result(result))
+
+    def plan(self, problem, request_ids, token):
+        (start_node, goal_shape, robot_parts, bbox, obstacles,
+         doorway_list, need_grid_display, route_rooms, engine) = problem
+        rrt_instance = RRT(robot_parts=robot_parts, bbox=bbox)
+        start_time = time.time()
+        stats = PlanStats()
+        def progress(event):
+            for request_id in request_ids:
+                self.post(request_id, event)
+        result = PathPlanner.do_planning(rrt_instance, start_node, goal_shape, obstacles,
+                                         doorway_list, need_grid_display, route_rooms,
+                                         PathPlanner.goal_fields, engine, token, progress, stats)
+        stats.add_time('total', time.time() - start_time)
+        stats.count('batch_requests', len(request_ids))
+        result.stats = stats
+        return result
+
+    @staticmethod
+    def copy_result(result):
+        "A copy of the result with its own shared memory copy of the grid display."
+        result = copy.copy(result)
+        if isinstance(result, PilotEvent):
+            result.args = dict(result.args)
+        PathPlannerProcess.map_grid_display(result, SharedArray)
+        return result
+
+
+def serve(address=default_address, authkey=default_authkey):
+    "Run the planning service in this process until it is killed."
+    if os.path.exists(address):  # left over from an earlier run
+        os.unlink(address)
+    service = PlanService()
+    PlanServiceManager.register('get_service', callable=lambda: service)
+    PlanServiceManager.register('get_reply_queue', callable=service.reply_queue)
+    manager = PlanServiceManager(address=address, authkey=authkey)
+    server = manager.get_server()
+    threading.Thread(target=service.run, daemon=True, name='PlanService').start()
+    print('Path planning service listening on', address)
+    server.serve_forever()
+
+
+class PlanServiceClient():
+    """Connection from one robot's program to the planning service.  A
+    thread forwards the service's replies to the robot's interprocess
+    queue, where the event router picks them up."""
+    def __init__(self, robot, address=default_address, authkey=default_authkey):
+        self.robot = robot
+        self.address = address
+        PlanServiceManager.register('get_service')
+        PlanServiceManager.register('get_reply_queue')
+        self.manager = PlanServiceManager(address=address, authkey=authkey)
+        self.manager.connect()
+        self.service = self.manager.get_service()
+        self.client_id = self.service.connect()
+        self.replies = self.manager.get_reply_queue(self.client_id)
+        self.running = True
+        self.thread = threading.Thread(target=self.forward_replies, daemon=True,
+                                       name='PlanServiceClient-%d' % self.client_id)
+        self.thread.start()
+
+    def __repr__(self):
+        return '<PlanServiceClient %d at %s>' % (self.client_id, self.address)
+
+    def forward_replies(self):
+        while self.running:
+            try:
+                reply = self.replies.get()
+            except (EOFError, OSError):
+                if self.running:
+                    print('PlanServiceClient: lost connection to', self.address)
+                return
+            if reply is None:  # posted by close()
+                return
+            (job_id, event) = reply
+            self.robot.erouter.interprocess_queue.put((job_id, event))
+
+    def submit(self, workhorse, job_id, args, reply_queue):
+        """Send a job made by PathPlannerProcess.create_job to the service.
+        Same signature as WorkerPool.submit; the service plans the job
+        itself, and the replies come back through forward_replies."""
+        self.service.submit(self.client_id, job_id, args)
+
+    def cancel(self, job_id):
+        self.service.cancel(self.client_id, job_id)
+
+    def get_stats(self):
+        return self.service.get_stats()
+
+    def close(self):
+        self.running = False
+        try:
+            self.replies.put(None)  # wake the forwarding thread
+            self.service.disconnect(self.client_id)
+        except (EOFError, OSError):
+            pass
+        self.thread.join(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Shared path planning service.')
+    parser.add_argument('--address', default=default_address,
+                        help='Unix socket path to listen on')
+    args = parser.parse_args()
+    serve(args.address)
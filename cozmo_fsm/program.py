@@ -26,6 +26,8 @@ from .rrt import RRT
 from .path_viewer import PathViewer
 from .worldmap_viewer import WorldMapViewer
 from .cam_viewer import CamViewer
+from .worker_pool import WorkerPool
+from .plan_service import PlanServiceClient, default_address as plan_service_address
 from .speech import SpeechListener, Thesaurus
 from . import opengl
 from . import custom_objs
@@ -67,6 +69,9 @@ class StateMachineProgram(StateNode):
                  speech_debug = False,
                  thesaurus = Thesaurus(),
 
+                 worker_pool = 2,  # number of workers for LaunchProcess nodes; 0 for none
+                 plan_service = None,  # address of a shared planning service, or True for the default
+
                  simple_cli_callback = None
                  ):
         super().__init__()
@@ -130,6 +135,9 @@ class StateMachineProgram(StateNode):
         self.speech_debug = speech_debug
         self.thesaurus = thesaurus
 
+        self.worker_pool = worker_pool
+        self.plan_service = plan_service
+
     def start(self):
         global running_fsm
         running_fsm = self
@@ -181,6 +189,30 @@ class StateMachineProgram(StateNode):
                 wcharger = self.robot.world.world_map.update_charger()
             self.simple_cli_callback(wc1, wc2, wc3, wcharger)
 
+        # Worker processes for LaunchProcess nodes.  The pool outlives the
+        # program, but must be restarted whenever the event router gets a
+        # new interprocess queue, as it does on every program start.
+        pool = getattr(self.robot, 'worker_pool', None)
+        if pool and pool.num_workers != self.worker_pool:
+            pool.shutdown()
+            pool = None
+        if self.worker_pool:
+            pool = pool or WorkerPool(self.worker_pool)
+            pool.ensure_running(self.robot.erouter.interprocess_queue)
+        self.robot.worker_pool = pool
+
+        # Shared path planning service (see plan_service.py).  The client
+        # forwards results to whatever the router's interprocess queue is,
+        # so it can be kept from one program to the next.
+        client = getattr(self.robot, 'plan_service', None)
+        address = plan_service_address if self.plan_service is True else self.plan_service
+        if client and client.address != address:
+            client.close()
+            client = None
+        if address and client is None:
+            client = PlanServiceClient(self.robot, address)
+        self.robot.plan_service = client
+
         # Polling
         self.set_polling_interval(0.025)  # for kine and motion model update
 
@@ -3,6 +3,8 @@ import numpy as np
 import random
 import time
 import math
+from collections import deque
+from statistics import median
 
 import cozmo_fsm.geometry
 from .geometry import wrap_angle
@@ -53,15 +55,147 @@ class GoalCollides(RRTException): pass
 class MaxIterations(RRTException): pass
 class GoalUnreachable(RRTException): pass
 class NotLocalized(RRTException): pass
+class PlanningAborted(RRTException): pass  # cancelled or out of time
+class PathBlocked(RRTException): pass  # a map change blocks a plan in progress
+
+#---------------- Samplers ----------------
+
+class RRTSampler():
+    """Base class for RRT sampling strategies.  The planner calls
+    prepare() once per plan, after the world bounds are computed, and
+    then calls sample() on every iteration.  The target argument is the
+    root of the tree we're trying to connect to.  The base class samples
+    uniformly from the world bounds."""
+
+    def prepare(self, rrt, start, goal):
+        pass
+
+    def sample(self, rrt, target=None):
+        return RRTNode(x=random.choice(rrt.bounds[0]),
+                       y=random.choice(rrt.bounds[1]))
+
+    def __repr__(self):
+        return '<%s>' % self.__class__.__name__
+
+class UniformSampler(RRTSampler):
+    """The default: sample uniformly from the world bounds."""
+    pass
+
+
+class GoalBiasSampler(RRTSampler):
+    """With probability goal_bias, sample the root of the other tree;
+    otherwise defer to the base sampler."""
+    def __init__(self, goal_bias=0.1, base=None):
+        self.goal_bias = goal_bias
+        self.base = base or UniformSampler()
+
+    def prepare(self, rrt, start, goal):
+        self.base.prepare(rrt, start, goal)
+
+    def sample(self, rrt, target=None):
+        if target is not None and random.random() < self.goal_bias:
+            return RRTNode(x=target.x, y=target.y)
+        return self.base.sample(rrt, target)
+
+    def __repr__(self):
+        return '<GoalBiasSampler %.2f over %s>' % (self.goal_bias, self.base)
+
+
+class InformedSampler(RRTSampler):
+    """Sample from an ellipse whose foci are the start and goal.  The
+    transverse diameter is slack times the start-goal distance, but at
+    least min_width mm more than it, so short plans can still get
+    around obstacles.  A fraction of the samples still come from the
+    base sampler so the planner remains complete when the corridor is
+    blocked."""
+    def __init__(self, slack=1.5, min_width=300, informed_fraction=0.8, base=None):
+        self.slack = slack
+        self.min_width = min_width
+        self.informed_fraction = informed_fraction
+        self.base = base or UniformSampler()
+
+    def prepare(self, rrt, start, goal):
+        self.base.prepare(rrt, start, goal)
+        dx = goal.x - start.x
+        dy = goal.y - start.y
+        c_min = sqrt(dx*dx + dy*dy)
+        c_max = max(self.slack * c_min, c_min + self.min_width)
+        self.center = ((start.x + goal.x) / 2, (start.y + goal.y) / 2)
+        self.heading = atan2(dy, dx)
+        self.semi_major = c_max / 2
+        self.semi_minor = sqrt(c_max*c_max - c_min*c_min) / 2
+
+    def sample(self, rrt, target=None):
+        if random.random() >= self.informed_fraction:
+            return self.base.sample(rrt, target)
+        # Uniform point in the unit disk, stretched into the ellipse
+        r = sqrt(random.random())
+        theta = random.uniform(-pi, pi)
+        ex = r * cos(theta) * self.semi_major
+        ey = r * sin(theta) * self.semi_minor
+        c = cos(self.heading)
+        s = sin(self.heading)
+        return RRTNode(x=self.center[0] + c*ex - s*ey,
+                       y=self.center[1] + s*ex + c*ey)
+
+    def __repr__(self):
+        return '<InformedSampler slack=%.2f>' % self.slack
+
+
+class FreeSpaceSampler(RRTSampler):
+    """Sample uniformly from a list of free grid cells, jittered within
+    the cell.  The free cells can be supplied (e.g., from an existing
+    WaveFront grid with from_wavefront), or else they are computed from
+    the RRT's obstacles when the plan starts."""
+    def __init__(self, free_cells=None, cell_size=20):
+        self.free_cells = free_cells
+        self.cell_size = cell_size
+        self.auto_cells = free_cells is None
+
+    @staticmethod
+    def from_wavefront(wf):
+        cells = np.argwhere(wf.grid == 0)
+        coords = np.array([wf.grid_to_coords(x,y) for (x,y) in cells])
+        return FreeSpaceSampler(free_cells=coords, cell_size=wf.square_size)
+
+    def prepare(self, rrt, start, goal):
+        if self.auto_cells:
+            self.free_cells = self.compute_free_cells(rrt)
+
+    def compute_free_cells(self, rrt):
+        from .wavefront import WaveFront
+        bbox = ((rrt.bounds[0].start, rrt.bounds[1].start),
+                (rrt.bounds[0].stop, rrt.bounds[1].stop))
+        wf = WaveFront(square_size=self.cell_size, bbox=bbox, inflate_size=0)
+        for obstacle in rrt.obstacles:
+            wf.add_obstacle(obstacle)
+        return __class__.from_wavefront(wf).free_cells
+
+    def sample(self, rrt, target=None):
+        if self.free_cells is None or len(self.free_cells) == 0:
+            return super().sample(rrt, target)
+        (x,y) = self.free_cells[random.randrange(len(self.free_cells))]
+        half = self.cell_size / 2
+        return RRTNode(x=x + random.uniform(-half,half),
+                       y=y + random.uniform(-half,half))
+
+    def __repr__(self):
+        n = 0 if self.free_cells is None else len(self.free_cells)
+        return '<FreeSpaceSampler %d cells>' % n
+
+
+#---------------- RRT Path Planner ----------------
 
 class RRT():
     DEFAULT_MAX_ITER = 2000
+    ITERATION_HISTORY_LENGTH = 100
 
     def __init__(self, robot=None, robot_parts=None, bbox=None,
                  max_iter=DEFAULT_MAX_ITER, step_size=10, arc_radius=40,
                  xy_tolsq=90, q_tol=5*pi/180,
                  obstacles=[], auto_obstacles=True,
-                 bounds=(range(-500,500), range(-500,500))):
+                 bounds=(range(-500,500), range(-500,500)),
+                 sampler=None):
         self.robot = robot
         self.max_iter = max_iter
         self.step_size = step_size
@@ -71,7 +205,9 @@ class RRT():
         self.q_tol = q_tol
         self.robot_parts = robot_parts if robot_parts is not None else self.make_robot_parts(robot) 
         self.bounds = bounds
+        self._obstacle_arrays = None
         self.obstacles = obstacles
+        self.segment_memo = dict()
         self.auto_obstacles = auto_obstacles
         self.treeA = []
         self.treeB = []
@@ -81,11 +217,30 @@ class RRT():
         self.path = []
         self.draw_path = []
         self.grid_display = None  # *** HACK to display wavefront grid
+        self.sampler = sampler or UniformSampler()
+        self.collision_checks = 0
+        self.smoothing_attempts = 0
+        # (obstacle_inflation, wall_inflation, doorway_adjustment) -> cached obstacle set
+        self.obstacle_cache = dict()
+        self.obstacle_cache_stats = dict(hits=0, misses=0, rebuilt=0)
+        self.last_iterations = None
+        # (iterations, success) for recent calls to plan_path
+        self.iteration_history = deque(maxlen=self.ITERATION_HISTORY_LENGTH)
 
     REACHED = 'reached'
     COLLISION = 'collision'
     INTERPOLATE = 'interpolate'
 
+    @property
+    def obstacles(self):
+        return self._obstacles
+
+    @obstacles.setter
+    def obstacles(self, obstacles):
+        self._obstacles = obstacles
+        self._obstacle_arrays = None  # rebuilt on demand by collides_poses
+        self.segment_memo = dict()
+
     def set_obstacles(self,obstacles):
         self.obstacles = obstacles
 
@@ -103,9 +258,11 @@ class RRT():
                 closest_node = this_node
         return closest_node
 
-    def random_node(self):
-        return RRTNode(x=random.choice(self.bounds[0]),
-                       y=random.choice(self.bounds[1]))
+    def set_sampler(self, sampler):
+        self.sampler = sampler
+
+    def random_node(self, target=None):
+        return self.sampler.sample(self, target)
 
     def extend(self, tree, target):
         nearest = self.nearest_node(tree, target)
@@ -154,12 +311,154 @@ class RRT():
         return parts
 
     def collides(self, node):
+        self.collision_checks += 1
         for part in self.robot_parts_to_node(node):
             for obstacle in self.obstacles:
                 if part.collides(obstacle):
                     return obstacle
         return False
 
+    def obstacle_arrays(self):
+        """Pack the Rectangle and Circle obstacles into arrays for
+        collides_poses.  Other shapes are returned in a list and are
+        checked one pose at a time."""
+        if self._obstacle_arrays is not None:
+            return self._obstacle_arrays
+        rects = [obst for obst in self.obstacles if isinstance(obst, Rectangle)]
+        circles = [obst for obst in self.obstacles if isinstance(obst, Circle)]
+        others = [obst for obst in self.obstacles if not isinstance(obst, (Rectangle,Circle))]
+        rect_arrays = (np.array([[r.center[0,0], r.center[1,0]] for r in rects]).reshape(-1,2),
+                       np.array([r.orient for r in rects], dtype=float),
+                       np.array([[(r.max_Ex-r.min_Ex)/2, (r.max_Ey-r.min_Ey)/2] for r in rects]).reshape(-1,2))
+        circle_arrays = (np.array([[c.center[0,0], c.center[1,0]] for c in circles]).reshape(-1,2),
+                         np.array([c.radius for c in circles], dtype=float))
+        self._obstacle_arrays = (rect_arrays, circle_arrays, others)
+        return self._obstacle_arrays
+
+    def collides_poses(self, xs, ys, qs):
+        """Vectorized version of collides() for an array of robot poses.
+        Returns a boolean array with one entry per pose."""
+        xs = np.atleast_1d(np.asarray(xs, dtype=float))
+        ys = np.atleast_1d(np.asarray(ys, dtype=float))
+        qs = np.atleast_1d(np.asarray(qs, dtype=float))
+        (xs, ys, qs) = np.broadcast_arrays(xs, ys, qs)
+        self.collision_checks += len(xs)
+        hits = np.zeros(len(xs), dtype=bool)
+        if len(xs) == 0:
+            return hits
+        ((rect_centers, rect_orients, rect_halves), (circ_centers, circ_radii), others) = \
+            self.obstacle_arrays()
+        fallback = others
+        cos_q = np.cos(qs)
+        sin_q = np.sin(qs)
+        for part in self.robot_parts:
+            # Instantiate the part at the origin the same way
+            # robot_parts_to_node does, then move it to each pose.
+            tmat = geometry.translate(part.center[0,0], part.center[1,0]).dot(
+                geometry.aboutZ(part.orient))
+            local = part.instantiate(tmat)
+            (lx, ly) = (local.center[0,0], local.center[1,0])
+            px = xs + cos_q*lx - sin_q*ly
+            py = ys + sin_q*lx + cos_q*ly
+            if isinstance(local, Rectangle):
+                hits |= self._rect_part_hits(px, py, qs + local.orient,
+                                             (local.max_Ex-local.min_Ex)/2,
+                                             (local.max_Ey-local.min_Ey)/2,
+                                             rect_centers, rect_orients, rect_halves,
+                                             circ_centers, circ_radii)
+            elif isinstance(local, Circle):
+                hits |= self._circle_part_hits(px, py, local.radius,
+                                               rect_centers, rect_orients, rect_halves,
+                                               circ_centers, circ_radii)
+            else:
+                fallback = self.obstacles  # unusual part shape: check everything
+        if fallback:
+            for k in np.flatnonzero(~hits):
+                node = RRTNode(x=xs[k], y=ys[k], q=qs[k])
+                for part in self.robot_parts_to_node(node):
+                    if any(part.collides(obstacle) for obstacle in fallback):
+                        hits[k] = True
+                        break
+        return hits
+
+    @staticmethod
+    def _rect_part_hits(px, py, pq, hx, hy,
+                        rect_centers, rect_orients, rect_halves,
+                        circ_centers, circ_radii):
+        # Separating axis test against every rectangle, same semantics
+        # as Rectangle.collides_rect: touching is not a collision.
+        hits = np.zeros(len(px), dtype=bool)
+        u = np.stack([np.cos(pq), np.sin(pq)], axis=1)[:,None,:]
+        v = np.stack([-np.sin(pq), np.cos(pq)], axis=1)[:,None,:]
+        if len(rect_orients) > 0:
+            d = rect_centers[None,:,:] - np.stack([px,py], axis=1)[:,None,:]
+            delta = pq[:,None] - rect_orients[None,:]
+            C = np.abs(np.cos(delta))
+            S = np.abs(np.sin(delta))
+            U = np.stack([np.cos(rect_orients), np.sin(rect_orients)], axis=1)[None,:,:]
+            V = np.stack([-np.sin(rect_orients), np.cos(rect_orients)], axis=1)[None,:,:]
+            Hx = rect_halves[None,:,0]
+            Hy = rect_halves[None,:,1]
+            overlap = (np.abs((d*u).sum(2)) < hx + Hx*C + Hy*S) & \
+                      (np.abs((d*v).sum(2)) < hy + Hx*S + Hy*C) & \
+                      (np.abs((d*U).sum(2)) < Hx + hx*C + hy*S) & \
+                      (np.abs((d*V).sum(2)) < Hy + hx*S + hy*C)
+            hits |= overlap.any(1)
+        if len(circ_radii) > 0:
+            d = circ_centers[None,:,:] - np.stack([px,py], axis=1)[:,None,:]
+            r = circ_radii[None,:]
+            overlap = (np.abs((d*u).sum(2)) < hx + r) & (np.abs((d*v).sum(2)) < hy + r)
+            hits |= overlap.any(1)
+        return hits
+
+    @staticmethod
+    def _circle_part_hits(px, py, radius,
+                          rect_centers, rect_orients, rect_halves,
+                          circ_centers, circ_radii):
+        hits = np.zeros(len(px), dtype=bool)
+        if len(rect_orients) > 0:
+            d = np.stack([px,py], axis=1)[:,None,:] - rect_centers[None,:,:]
+            U = np.stack([np.cos(rect_orients), np.sin(rect_orients)], axis=1)[None,:,:]
+            V = np.stack([-np.sin(rect_orients), np.cos(rect_orients)], axis=1)[None,:,:]
+            overlap = (np.abs((d*U).sum(2)) < rect_halves[None,:,0] + radius) & \
+                      (np.abs((d*V).sum(2)) < rect_halves[None,:,1] + radius)
+            hits |= overlap.any(1)
+        if len(circ_radii) > 0:
+            d = np.stack([px,py], axis=1)[:,None,:] - circ_centers[None,:,:]
+            hits |= (np.sqrt((d*d).sum(2)) < radius + circ_radii[None,:]).any(1)
+        return hits
+
+    def segment_collides(self, x, y, q, dist):
+        """True if the robot collides while driving dist mm from (x,y) on
+        heading q.  Poses are checked every step_size mm in one batch.
+        Results are memoized until the obstacles change."""
+        key = ('line', round(x,1), round(y,1), round(q,4), round(dist,1))
+        result = self.segment_memo.get(key)
+        if result is None:
+            n = max(1, int(ceil(dist / self.step_size)))
+            traveled = np.minimum(np.arange(1, n+1) * self.step_size, dist)
+            result = bool(self.collides_poses(x + traveled*cos(q),
+                                              y + traveled*sin(q),
+                                              q).any())
+            self.segment_memo[key] = result
+        return result
+
+    def arc_collides(self, cx, cy, start_q, turn, dir):
+        """True if the robot collides anywhere along an arc of the given
+        turn about (cx,cy), checked every q_tol radians in one batch."""
+        key = ('arc', round(cx,1), round(cy,1), round(start_q,4), round(turn,4), dir)
+        result = self.segment_memo.get(key)
+        if result is None:
+            n = int(ceil(abs(turn) / self.q_tol))
+            q_traveled = dir * self.q_tol * np.arange(n)
+            q_traveled = q_traveled[np.abs(q_traveled) < abs(turn)]
+            angles = start_q + q_traveled
+            result = bool(self.collides_poses(cx + self.arc_radius * np.cos(angles),
+                                              cy + self.arc_radius * np.sin(angles),
+                                              angles).any())
+            self.segment_memo[key] = result
+        return result
+
     def all_colliders(self, node):
         result = []
         for part in self.robot_parts_to_node(node):
@@ -226,11 +525,12 @@ class RRT():
 
         # Set bounds for search area
         self.compute_world_bounds(start,goal)
+        self.sampler.prepare(self, start, goal)
 
         # Grow the RRT until trees meet or max_iter exceeded
         swapped = False
         for i in range(self.max_iter):
-            r = self.random_node()
+            r = self.random_node(treeB[0])
             (status, new_node) = self.extend(treeA, r)
             if status is not self.COLLISION:
                 (status, new_node) = self.extend(treeB, treeA[-1])
@@ -241,11 +541,34 @@ class RRT():
         # Search terminated. Check for success.
         if swapped:
             (treeA, treeB) = (treeB, treeA)
+        self.last_iterations = i + 1
+        self.iteration_history.append((self.last_iterations, status is self.REACHED))
         if status is self.REACHED:
             return self.get_path(treeA, treeB)
         else:
             raise MaxIterations(self.max_iter)
 
+    def iteration_stats(self):
+        """Summarize iterations-to-solution over recent calls to plan_path."""
+        history = list(self.iteration_history)
+        solved = [n for (n,success) in history if success]
+        return dict(sampler = repr(self.sampler),
+                    plans = len(history),
+                    failures = len(history) - len(solved),
+                    median = median(solved) if solved else None,
+                    mean = sum(solved)/len(solved) if solved else None,
+                    max = max(solved) if solved else None)
+
+    def show_iteration_stats(self):
+        stats = self.iteration_stats()
+        if stats['plans'] == 0:
+            print('No RRT plans yet.')
+            return
+        print('%s: %d plans, %d failures' % (stats['sampler'], stats['plans'], stats['failures']))
+        if stats['median'] is not None:
+            print('  iterations: median %d, mean %.1f, max %d' %
+                  (stats['median'], stats['mean'], stats['max']))
+
     def compute_world_bounds(self,start,goal):
         xmin = min(start.x, goal.x)
         xmax = max(start.x, goal.x)
@@ -306,42 +629,48 @@ class RRT():
         print('*** JOIN PATHS EXCEEDED MAX TURN ANGLE: ', turn_angle*180/pi)
         return (pathA,pathB)
 
-    def smooth_path(self):
-        """Smooth a path by picking random subsequences and replacing
-        them with a direct link if there is no collision."""
+    def smooth_path(self, until=None):
+        """Smooth a path by greedy shortcutting: starting from each node
+        i in turn, replace the nodes up to the farthest node j that can
+        be reached without collision by a direct link (or an arc if the
+        turn is too sharp).  Segments are checked as batches of poses,
+        and the result is deterministic.  If until is supplied, it is
+        called with the partly smoothed path before each node; smoothing
+        stops early, keeping the path so far, if it returns True."""
         smoothed_path = self.path
-        for _ in range(0,len(smoothed_path)):
+        i = 0
+        while i < len(smoothed_path) - 2:
+            if until and until(smoothed_path):
+                break
             L = len(smoothed_path)
-            if L <= 2: break
-            i = random.randrange(0,L-2)
-            cur_x = smoothed_path[i].x
-            cur_y = smoothed_path[i].y
-            cur_q = smoothed_path[i].q
-            j = random.randrange(i+2, L)
-            if j < L-1 and smoothed_path[j+1].radius != None:
-                continue  # j is parent node of an arc segment: don't touch
-            dx = smoothed_path[j].x - cur_x
-            dy = smoothed_path[j].y - cur_y
-            new_q = atan2(dy,dx)
-            dist = sqrt(dx**2 + dy**2)
-            turn_angle = wrap_angle(new_q - cur_q)
-            if abs(turn_angle) <= self.max_turn:
-                result = self.try_linear_smooth(smoothed_path,i,j,cur_x,cur_y,new_q,dist)
-            else:
-                result = self.try_arc_smooth(smoothed_path,i,j,cur_x,cur_y,cur_q)
-            smoothed_path = result or smoothed_path
+            for j in range(L-1, i+1, -1):
+                if j < L-1 and smoothed_path[j+1].radius != None:
+                    continue  # j is parent node of an arc segment: don't touch
+                result = self.try_smooth(smoothed_path, i, j)
+                if result:
+                    smoothed_path = result
+                    break
+            i += 1
         self.path = smoothed_path
 
+    def try_smooth(self, smoothed_path, i, j):
+        self.smoothing_attempts += 1
+        cur_x = smoothed_path[i].x
+        cur_y = smoothed_path[i].y
+        cur_q = smoothed_path[i].q
+        dx = smoothed_path[j].x - cur_x
+        dy = smoothed_path[j].y - cur_y
+        new_q = atan2(dy,dx)
+        dist = sqrt(dx**2 + dy**2)
+        turn_angle = wrap_angle(new_q - cur_q)
+        if isnan(cur_q) or abs(turn_angle) <= self.max_turn:
+            return self.try_linear_smooth(smoothed_path,i,j,cur_x,cur_y,new_q,dist)
+        else:
+            return self.try_arc_smooth(smoothed_path,i,j,cur_x,cur_y,cur_q)
+
     def try_linear_smooth(self,smoothed_path,i,j,cur_x,cur_y,new_q,dist):
-        step_x = self.step_size * cos(new_q)
-        step_y = self.step_size * sin(new_q)
-        traveled = 0
-        while traveled < dist:
-            traveled += self.step_size
-            cur_x += step_x
-            cur_y += step_y
-            if self.collides(RRTNode(None, cur_x, cur_y, new_q)):
-                return None
+        if self.segment_collides(cur_x, cur_y, new_q, dist):
+            return None
         # Since we're arriving at node j via a different heading than
         # before, see if we need to add an arc to get us to node k=j+1
         node_i = smoothed_path[i]
@@ -432,30 +761,13 @@ class RRT():
             (tang_x,tang_y,tang_q,turn) = (tang_x1,tang_y1,tang_q1,turn1)
         else:
             (tang_x,tang_y,tang_q,turn) = (tang_x2,tang_y2,tang_q2,turn2)
-        # Interpolate along the arc and check for collision.
-        q_traveled = 0
-        while abs(q_traveled) < abs(turn):
-            cur_x = cx + self.arc_radius * cos(cur_q + q_traveled)
-            cur_y = cy + self.arc_radius * sin(cur_q + q_traveled)
-            if self.collides(RRTNode(None, cur_x, cur_y, cur_q+q_traveled)):
-                return None
-            q_traveled += dir * self.q_tol
-        # Now interpolate from the tangent point to the target.
-        cur_x = tang_x
-        cur_y = tang_y
-        dx = dest_x - cur_x
-        dy = dest_y - cur_y
-        new_q = atan2(dy, dx)
-        dist = sqrt(dx*dx + dy*dy)
-        step_x = self.step_size * cos(new_q)
-        step_y = self.step_size * sin(new_q)
-        traveled = 0
-        while traveled < dist:
-            traveled += self.step_size
-            cur_x += step_x
-            cur_y += step_y
-            if self.collides(RRTNode(None, cur_x, cur_y, new_q)):
-                return None
+        # Check the arc, then the line from the tangent point to the target.
+        if self.arc_collides(cx, cy, cur_q, turn, dir):
+            return None
+        dx = dest_x - tang_x
+        dy = dest_y - tang_y
+        if self.segment_collides(tang_x, tang_y, atan2(dy,dx), sqrt(dx*dx + dy*dy)):
+            return None
         # No collision, so arc is good.
         return (tang_x, tang_y, tang_q, dir*self.arc_radius)
 
@@ -499,24 +811,61 @@ class RRT():
     #---------------- Obstacle Representation ----------------
 
     def generate_obstacles(self, obstacle_inflation=0, wall_inflation=0, doorway_adjustment=0):
-        self.robot.world.world_map.update_map()
+        """Generate obstacles from the world map.  Results are cached per
+        set of inflation parameters and reused while the world map version
+        is unchanged; when it changes, only objects whose signature
+        changed are regenerated."""
+        world_map = self.robot.world.world_map
+        world_map.update_map()
+        key = (obstacle_inflation, wall_inflation, doorway_adjustment)
+        cache = self.obstacle_cache.get(key)
+        if cache and cache['version'] == world_map.version and \
+           cache['carrying'] is self.robot.carrying:
+            self.obstacle_cache_stats['hits'] += 1
+            self.obstacles = list(cache['obstacles'])
+            return
+        self.obstacle_cache_stats['misses'] += 1
+        old_entries = cache['entries'] if cache else dict()
+        entries = dict()
         obstacles = []
-        for obj in self.robot.world.world_map.objects.values():
+        for (obj_key, obj) in world_map.objects.items():
             if not obj.is_obstacle: continue
             if self.robot.carrying is obj: continue
             if obj.pose_confidence < 0: continue
-            if isinstance(obj, WallObj):
-                obstacles = obstacles + \
-                            self.generate_wall_obstacles(obj, wall_inflation, doorway_adjustment)
-            elif isinstance(obj, (LightCubeObj,CustomCubeObj,ChargerObj)):
-                obstacles.append(self.generate_cube_obstacle(obj, obstacle_inflation))
-            elif isinstance(obj, CustomMarkerObj):
-                obstacles.append(self.generate_marker_obstacle(obj,obstacle_inflation))
-            elif isinstance(obj, ChipObj):
-                obstacles.append(self.generate_chip_obstacle(obj,obstacle_inflation))
-            elif isinstance(obj, RobotForeignObj):
-               obstacles.append(self.generate_foreign_obstacle(obj))
-        self.obstacles = obstacles
+            signature = world_map.object_signatures.get(obj_key)
+            old_entry = old_entries.get(obj_key)
+            if signature is not None and old_entry and \
+               old_entry[0] == signature and old_entry[1] is obj:
+                shapes = old_entry[2]
+            else:
+                self.obstacle_cache_stats['rebuilt'] += 1
+                shapes = self.generate_object_obstacles(obj, obstacle_inflation,
+                                                        wall_inflation, doorway_adjustment)
+            entries[obj_key] = (signature, obj, shapes)
+            obstacles = obstacles + shapes
+        self.obstacle_cache[key] = dict(version=world_map.version,
+                                        carrying=self.robot.carrying,
+                                        entries=entries,
+                                        obstacles=obstacles)
+        self.obstacles = list(obstacles)
+
+    def generate_object_obstacles(self, obj, obstacle_inflation=0, wall_inflation=0, doorway_adjustment=0):
+        """Returns a list of obstacle shapes for a single world map object."""
+        if isinstance(obj, WallObj):
+            return self.generate_wall_obstacles(obj, wall_inflation, doorway_adjustment)
+        elif isinstance(obj, (LightCubeObj,CustomCubeObj,ChargerObj)):
+            return [self.generate_cube_obstacle(obj, obstacle_inflation)]
+        elif isinstance(obj, CustomMarkerObj):
+            return [self.generate_marker_obstacle(obj,obstacle_inflation)]
+        elif isinstance(obj, ChipObj):
+            return [self.generate_chip_obstacle(obj,obstacle_inflation)]
+        elif isinstance(obj, RobotForeignObj):
+            return [self.generate_foreign_obstacle(obj)]
+        else:
+            return []
+
+    def clear_obstacle_cache(self):
+        self.obstacle_cache.clear()
 
     @staticmethod
     def generate_wall_obstacles(wall, wall_inflation, doorway_adjustment):
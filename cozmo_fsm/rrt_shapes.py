@@ -1,3 +1,4 @@
+import hashlib
 from cozmo_fsm import geometry
 from math import sqrt, pi, atan2
 import numpy as np
@@ -173,3 +174,76 @@ class Compound(Shape):
                 return True
         return False
 
+
+#================ Packed Shape Tables ================
+
+# Shape lists are packed into flat float arrays, one per shape type, so
+# they are cheap to send to another process and cheap to fingerprint.
+# Only the x,y coordinates survive packing.
+
+CIRCLE, RECTANGLE, POLYGON = 0, 1, 2
+
+def pack_shapes(shapes):
+    """Pack a list of Circles, Rectangles, and Polygons into a dict of
+    numpy arrays plus the list of obstacle ids, preserving order."""
+    kinds = np.zeros(len(shapes), dtype=np.int8)
+    circles = []
+    rectangles = []
+    polygon_sizes = []
+    polygon_vertices = []
+    for (i,shape) in enumerate(shapes):
+        if isinstance(shape, Circle):
+            kinds[i] = CIRCLE
+            circles.append((shape.center[0,0], shape.center[1,0], shape.radius))
+        elif isinstance(shape, Rectangle):
+            kinds[i] = RECTANGLE
+            rectangles.append((shape.center[0,0], shape.center[1,0],
+                               shape.dimensions[0], shape.dimensions[1], shape.orient))
+        elif isinstance(shape, Polygon):
+            kinds[i] = POLYGON
+            polygon_sizes.append(shape.vertices.shape[1])
+            polygon_vertices.append(shape.vertices[0:2,:])
+        else:
+            raise TypeError("Can't pack %s" % shape)
+    return dict(kinds = kinds,
+                circles = np.array(circles, dtype=float).reshape(-1,3),
+                rectangles = np.array(rectangles, dtype=float).reshape(-1,5),
+                polygon_sizes = np.array(polygon_sizes, dtype=np.int32),
+                polygon_vertices = np.hstack(polygon_vertices) if polygon_vertices
+                                   else np.zeros((2,0)),
+                obstacle_ids = [shape.obstacle_id for shape in shapes])
+
+def table_digest(table):
+    """Hex digest of a table made by pack_shapes, for use as a cache key.
+    Equal shape lists give equal digests in any process."""
+    md5 = hashlib.md5()
+    for name in ('kinds', 'circles', 'rectangles', 'polygon_sizes', 'polygon_vertices'):
+        md5.update(np.ascontiguousarray(table[name]).tobytes())
+    md5.update(repr(table['obstacle_ids']).encode())
+    return md5.hexdigest()
+
+def unpack_shapes(table):
+    "Rebuild the list of shapes packed by pack_shapes."
+    shapes = []
+    (nc, nr, npoly, nv) = (0, 0, 0, 0)
+    for (kind, obstacle_id) in zip(table['kinds'], table['obstacle_ids']):
+        if kind == CIRCLE:
+            (x, y, radius) = table['circles'][nc]
+            nc += 1
+            shape = Circle(center=geometry.point(x,y), radius=float(radius))
+        elif kind == RECTANGLE:
+            (x, y, dx, dy, orient) = table['rectangles'][nr]
+            nr += 1
+            shape = Rectangle(center=geometry.point(x,y),
+                              dimensions=(float(dx), float(dy)), orient=float(orient))
+        else:
+            size = table['polygon_sizes'][npoly]
+            npoly += 1
+            vertices = np.ones((4,size))
+            vertices[0:2,:] = table['polygon_vertices'][:, nv:nv+size]
+            vertices[2,:] = 0
+            nv += size
+            shape = Polygon(vertices=vertices)
+        shape.obstacle_id = obstacle_id
+        shapes.append(shape)
+    return shapes
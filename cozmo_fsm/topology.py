@@ -0,0 +1,137 @@
+"""
+Room and doorway graph for hierarchical path planning.
+
+Rooms are nodes and doorways are the links between them.  A route
+through the graph tells the path planner which rooms the robot must
+pass through, so the grid search only has to cover those rooms.
+"""
+
+import heapq
+import numpy as np
+from math import sin, cos, sqrt
+
+from .geometry import points_in_polygon
+from .worldmap import RoomObj, DoorwayObj
+
+class RoomGraph():
+    probe_distance = 100  # mm on either side of a doorway to look for a room
+
+    def __init__(self, world_map):
+        self.version = world_map.version
+        self.signature = self.map_signature(world_map)
+        self.rooms = dict()
+        self.doorways = dict()
+        for obj in world_map.objects.values():
+            if isinstance(obj, RoomObj):
+                self.rooms[obj.id] = obj
+            elif isinstance(obj, DoorwayObj) and obj.pose_confidence >= 0:
+                self.doorways[obj.id] = obj
+        # Which rooms each doorway joins, and which doorways each room has.
+        self.doorway_rooms = dict()
+        self.room_doorways = dict((room_id, []) for room_id in self.rooms)
+        for door in self.doorways.values():
+            room_ids = self.find_doorway_rooms(door)
+            self.doorway_rooms[door.id] = room_ids
+            for room_id in room_ids:
+                self.room_doorways[room_id].append(door.id)
+        # Doorway-to-doorway costs across each room.
+        self.doorway_costs = dict()
+        for (room_id, door_ids) in self.room_doorways.items():
+            for d1 in door_ids:
+                for d2 in door_ids:
+                    if d1 != d2:
+                        self.doorway_costs[(d1,d2,room_id)] = \
+                            self.distance(self.doorway_point(d1), self.doorway_point(d2))
+
+    @staticmethod
+    def map_signature(world_map):
+        "Signatures of the map's rooms and doorways, the only objects the graph depends on."
+        return sorted((key, signature) for (key, signature) in world_map.object_signatures.items()
+                      if isinstance(world_map.objects.get(key), (RoomObj, DoorwayObj)))
+
+    def __repr__(self):
+        return '<RoomGraph: %d rooms, %d doorways, version %d>' % \
+               (len(self.rooms), len(self.doorways), self.version)
+
+    def find_doorway_rooms(self, door):
+        """Rooms on either side of a doorway, either listed in the room's
+        door_ids or found by probing across the doorway."""
+        room_ids = []
+        for room in self.rooms.values():
+            if door.id in room.door_ids or door.marker_ids[0] in room.door_ids:
+                room_ids.append(room.id)
+        (dx, dy) = (self.probe_distance * cos(door.theta), self.probe_distance * sin(door.theta))
+        for (x, y) in ((door.x + dx, door.y + dy), (door.x - dx, door.y - dy)):
+            room = self.room_containing(x, y)
+            if room and room.id not in room_ids:
+                room_ids.append(room.id)
+        return room_ids
+
+    def room_containing(self, x, y):
+        for room in self.rooms.values():
+            if points_in_polygon(np.array([x]), np.array([y]), room.points)[0]:
+                return room
+        return None
+
+    def doorway_point(self, door_id):
+        door = self.doorways[door_id]
+        return (door.x, door.y)
+
+    @staticmethod
+    def distance(p1, p2):
+        return sqrt((p1[0]-p2[0])**2 + (p1[1]-p2[1])**2)
+
+    def route(self, start, goal):
+        """Cheapest sequence of room ids leading from the start point to the
+        goal point, or None if either point is outside every room or no
+        route exists.  Costs are straight-line distances between doorways."""
+        start_room = self.room_containing(*start)
+        goal_room = self.room_containing(*goal)
+        if start_room is None or goal_room is None:
+            return None
+        if start_room is goal_room:
+            return [start_room.id]
+        # Dijkstra over doorways; each entry is (cost, door_id, rooms so
+        # far).  An empty door_id marks an entry that has reached the goal.
+        fringe = []
+        for door_id in self.room_doorways[start_room.id]:
+            cost = self.distance(start, self.doorway_point(door_id))
+            heapq.heappush(fringe, (cost, door_id, [start_room.id]))
+        done = set()
+        while fringe:
+            (cost, door_id, rooms) = heapq.heappop(fringe)
+            if door_id == '':
+                return rooms
+            if door_id in done: continue
+            done.add(door_id)
+            for room_id in self.doorway_rooms[door_id]:
+                if room_id in rooms: continue
+                if room_id == goal_room.id:
+                    heapq.heappush(fringe, (cost + self.distance(self.doorway_point(door_id), goal),
+                                            '', rooms + [room_id]))
+                    continue
+                for next_door in self.room_doorways[room_id]:
+                    if next_door not in done:
+                        heapq.heappush(fringe, (cost + self.doorway_costs[(door_id,next_door,room_id)],
+                                                next_door, rooms + [room_id]))
+        return None
+
+    def route_polygons(self, start, goal):
+        "Vertices of the rooms on the route from start to goal, or None."
+        room_ids = self.route(start, goal)
+        if room_ids is None:
+            return None
+        return [self.rooms[room_id].points for room_id in room_ids]
+
+
+def get_room_graph(world_map):
+    """The room graph for this world map, rebuilt only when a room or
+    doorway changes, not when other objects such as cubes move."""
+    graph = world_map.room_graph
+    if graph is not None and graph.version != world_map.version and \
+       graph.signature == RoomGraph.map_signature(world_map):
+        graph.version = world_map.version
+    if graph is None or graph.version != world_map.version:
+        graph = RoomGraph(world_map)
+        world_map.room_graph = graph
+    return graph
@@ -2,17 +2,59 @@
 Wavefront path planning algorithm.
 """
 
+import copy
+import functools
+import time
 import numpy as np
 import heapq
 from math import floor, ceil, cos, sin
 
-from .geometry import wrap_angle, rotate_point, polygon_fill, check_concave
-from .rrt import StartCollides
+from .geometry import wrap_angle, rotate_point
+from .geometry import points_in_polygon, polygon_edge_distance, polygon_mask
+from .rrt import StartCollides, PlanningAborted
 from .rrt_shapes import *
 from .worldmap import LightCubeObj, ChargerObj, CustomMarkerObj
 
+def dilate_mask(mask, radius):
+    """Grow a boolean grid mask by radius cells in every direction
+    (a square structuring element), using shifted ORs along each axis."""
+    result = mask.copy()
+    for axis in (0, 1):
+        source = result.copy()
+        n = source.shape[axis]
+        for k in range(1, min(radius, n-1) + 1):
+            lo = [slice(None), slice(None)]
+            hi = [slice(None), slice(None)]
+            lo[axis] = slice(0, n-k)
+            hi[axis] = slice(k, n)
+            result[tuple(hi)] |= source[tuple(lo)]
+            result[tuple(lo)] |= source[tuple(hi)]
+    return result
+
+def timed(phase, counts_cells=False):
+    """Decorator for WaveFront methods: if the WaveFront has a stats
+    object (see path_planner.PlanStats), add the method's run time to
+    the phase, and count the cells it expanded."""
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.stats is None:
+                return method(self, *args, **kwargs)
+            start_time = time.time()
+            self.cells_expanded = 0
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.stats.add_time(phase, time.time() - start_time)
+                if counts_cells:
+                    self.stats.count('cells_expanded', self.cells_expanded)
+        return wrapper
+    return decorate
+
+
 class WaveFront():
     goal_marker = 2**31 - 1
+    outside_marker = -(2**31 - 1)  # cells outside a coarse-to-fine corridor
 
     def __init__(self, square_size=5, bbox=None, grid_shape=(100,100), inflate_size=50):
         self.square_size = square_size  # in mm
@@ -21,6 +63,10 @@ class WaveFront():
         self.grid_shape = grid_shape  # array shape
         self.initialize_grid(bbox=bbox)
         self.obstacles = dict()
+        self.warn_outside = True  # complain about goal cells outside the grid
+        self.region = None  # room polygons the grid is confined to, if any
+        self.cancel_token = None  # worker_pool.CancelToken checked during inflation and searches
+        self.stats = None  # path_planner.PlanStats to record timings in
 
     def initialize_grid(self,bbox=None):
         if bbox:
@@ -29,6 +75,10 @@ class WaveFront():
                               ceil((bbox[1][1] - bbox[0][1] + 4*self.inflate_size)/self.square_size))
         self.grid = np.zeros(self.grid_shape, dtype=np.int32)
         self.maxdist = 1
+        self.cells_expanded = 0
+        self.clearance = None
+        self.nearest_obstacle = None
+        self.clearance_distance = 0
 
     def coords_to_grid(self,xcoord,ycoord):
         "Convert world map coordinates to grid subscripts."
@@ -52,30 +102,143 @@ class WaveFront():
         if x is not None:
             self.grid[x,y] = obstacle_id
 
-    def add_obstacle(self, obstacle):
+    def add_obstacle(self, obstacle, pad=None):
         obstacle_id = -(1 + len(self.obstacles))
         self.obstacles[obstacle_id] = obstacle
-        if isinstance(obstacle, Rectangle):
-            centerX, centerY = obstacle.center[0,0], obstacle.center[1,0]
-            width, height = obstacle.dimensions[0], obstacle.dimensions[1]
-            theta = wrap_angle(obstacle.orient)
-            for x in range(floor(centerX-width/2),
-                           ceil(centerX+width/2),
-                           int(self.square_size/2)):
-                for y in range(floor(centerY-height/2),
-                               ceil(centerY+height/2),
-                               int(self.square_size/2)):
-                    new_x = ((x - centerX) * cos(theta) - (y - centerY) * sin(theta)) + centerX
-                    new_y = ((x - centerX) * sin(theta) + (y - centerY) * cos(theta)) + centerY
-                    self.set_obstacle_cell(new_x, new_y, obstacle_id)
-        elif isinstance(obstacle, Polygon):
-            raise NotImplemented(obstacle)
-        elif isinstance(obstacle, Circle):
-            raise NotImplemented(obstacle)
-        elif isinstance(obstacle, Compound):
-            raise NotImplemented(obstacle)
-        else:
-            raise Exception("%s has no add_obstacle() method defined for %s." % (self, obstacle))
+        self.fill_shape(obstacle, obstacle_id, pad)
+
+    def compute_clearance(self, max_distance):
+        """
+        Chamfer (10/14) distance transform of the obstacle cells, out to
+        max_distance mm.  self.clearance gets the distance from each cell
+        to the nearest obstacle cell in tenths of a grid square, and
+        self.nearest_obstacle gets that obstacle's id.  This is the same
+        bucket expansion as dial_expand(), seeded at every obstacle cell,
+        so only the band of cells near obstacles is ever touched.  Raises
+        PlanningAborted if the cancel token expires.
+        """
+        (W,H) = self.grid_shape
+        stride = H + 2
+        padded = np.full((W+2, H+2), self.border_marker, dtype=np.int32)
+        padded[1:-1, 1:-1] = self.grid
+        flat = padded.ravel()
+        far = np.iinfo(np.int32).max
+        clearance = np.full(flat.size, far, dtype=np.int32)
+        nearest = np.zeros(flat.size, dtype=np.int32)
+        seeds = np.flatnonzero((flat < 0) & (flat != self.border_marker) &
+                               (flat != self.outside_marker))
+        clearance[seeds] = 0
+        nearest[seeds] = flat[seeds]
+        steps = ((10, np.array([-stride, stride, -1, 1])),
+                 (14, np.array([-stride-1, -stride+1, stride-1, stride+1])))
+        limit = round(max_distance * 10 / self.square_size)
+        buckets = {0: [(seeds, flat[seeds])]}
+        pending = [0]
+        while pending:
+            dist = heapq.heappop(pending)
+            if dist > limit: break
+            self.check_cancel()
+            cells = np.concatenate([c for (c,l) in buckets[dist]])
+            labels = np.concatenate([l for (c,l) in buckets.pop(dist)])
+            if dist > 0:
+                (cells, first) = np.unique(cells, return_index=True)
+                labels = labels[first]
+                new = clearance[cells] == far
+                (cells, labels) = (cells[new], labels[new])
+                clearance[cells] = dist
+                nearest[cells] = labels
+            for (cost, offsets) in steps:
+                neighbors = (cells[:,None] + offsets).ravel()
+                open_cells = (flat[neighbors] == 0) & (clearance[neighbors] == far)
+                if open_cells.any():
+                    newdist = dist + cost
+                    if newdist not in buckets:
+                        buckets[newdist] = []
+                        heapq.heappush(pending, newdist)
+                    buckets[newdist].append((neighbors[open_cells],
+                                             np.repeat(labels, len(offsets))[open_cells]))
+        self.clearance = clearance.reshape(W+2, H+2)[1:-1, 1:-1]
+        self.nearest_obstacle = nearest.reshape(W+2, H+2)[1:-1, 1:-1]
+        self.clearance_distance = max_distance
+
+    @timed('inflate')
+    def inflated(self, obstacle_inflation, wall_inflation):
+        """
+        Return a copy of this WaveFront with each obstacle grown by
+        obstacle_inflation mm, or wall_inflation mm for walls, by
+        thresholding the clearance map from compute_clearance().  The
+        grown cells are labeled with the nearest obstacle's id.
+        """
+        max_inflation = max(obstacle_inflation, wall_inflation)
+        if self.clearance is None or self.clearance_distance < max_inflation:
+            self.compute_clearance(max_inflation)
+        limits = np.zeros(len(self.obstacles)+1, dtype=np.int32)
+        for (obstacle_id, obstacle) in self.obstacles.items():
+            inflation = wall_inflation if obstacle.obstacle_id.startswith('Wall') \
+                        else obstacle_inflation
+            limits[-obstacle_id] = round(inflation * 10 / self.square_size)
+        nearest = self.nearest_obstacle
+        grow = (self.grid == 0) & (nearest < 0) & \
+               (self.clearance <= limits[-np.minimum(nearest, 0)])
+        wf = copy.copy(self)
+        wf.grid = self.grid.copy()
+        wf.grid[grow] = nearest[grow]
+        wf.obstacles = dict(self.obstacles)
+        wf.clearance = None
+        wf.nearest_obstacle = None
+        return wf
+
+    def cell_centers(self, xmin, ymin, xmax, ymax, pad=0):
+        """Return grid slices covering a world coordinate bounding box
+        (grown by pad mm), and the world coordinates of the centers of
+        the cells in those slices."""
+        xorigin = self.bbox[0][0] - 2*self.inflate_size
+        yorigin = self.bbox[0][1] - 2*self.inflate_size
+        x0 = max(0, floor((xmin - pad - xorigin) / self.square_size))
+        y0 = max(0, floor((ymin - pad - yorigin) / self.square_size))
+        x1 = min(self.grid_shape[0], ceil((xmax + pad - xorigin) / self.square_size) + 1)
+        y1 = min(self.grid_shape[1], ceil((ymax + pad - yorigin) / self.square_size) + 1)
+        xs = xorigin + self.square_size * np.arange(x0, max(x0,x1))
+        ys = yorigin + self.square_size * np.arange(y0, max(y0,y1))
+        (gx, gy) = np.meshgrid(xs, ys, indexing='ij')
+        return ((slice(x0,x1), slice(y0,y1)), gx, gy)
+
+    def fill_shape(self, shape, value, pad=None):
+        """Set every cell whose center lies within pad mm of the shape to
+        value, using one array operation per shape.  The default pad of
+        half a cell marks every cell the shape touches."""
+        if pad is None:
+            pad = self.square_size / 2
+        if isinstance(shape, Compound):
+            for s in shape.shapes:
+                self.fill_shape(s, value, pad)
+            return
+        if not isinstance(shape, (Polygon, Circle)):
+            raise Exception("%s has no fill_shape() method defined for %s." % (self, shape))
+        ((xmin,ymin), (xmax,ymax)) = shape.get_bounding_box()
+        (slices, gx, gy) = self.cell_centers(xmin, ymin, xmax, ymax, pad)
+        if gx.size == 0: return
+        self.grid[slices][self.shape_mask(shape, gx, gy, pad)] = value
+
+    @staticmethod
+    def shape_mask(shape, gx, gy, pad=0):
+        "Boolean mask of the points (gx,gy) within pad mm of the shape."
+        cx = shape.center[0,0]
+        cy = shape.center[1,0]
+        if isinstance(shape, Rectangle):
+            theta = wrap_angle(shape.orient)
+            (dx, dy) = (gx - cx, gy - cy)
+            lx = dx * cos(theta) + dy * sin(theta)
+            ly = -dx * sin(theta) + dy * cos(theta)
+            return (np.abs(lx) <= shape.dimensions[0]/2 + pad) & \
+                   (np.abs(ly) <= shape.dimensions[1]/2 + pad)
+        elif isinstance(shape, Circle):
+            return np.hypot(gx - cx, gy - cy) <= shape.radius + pad
+        else:  # general Polygon
+            mask = points_in_polygon(gx, gy, shape.vertices)
+            if pad > 0:
+                mask |= polygon_edge_distance(gx, gy, shape.vertices) <= pad
+            return mask
 
     def set_goal_cell(self,xcoord,ycoord):
         self.set_cell_contents(xcoord,ycoord,self.goal_marker)
@@ -87,35 +250,40 @@ class WaveFront():
         (x,y) = self.coords_to_grid(xcoord,ycoord)
         if x is not None:
             self.grid[x,y] = contents
-        else:
+        elif self.warn_outside:
             print('**** bbox=', self.bbox, '  grid_shape=', self.grid_shape,
                   '  x,y=', (x,y), '  xcoord,ycoord=', (xcoord,ycoord))
             print(ValueError('Coordinates (%s, %s) are outside the wavefront grid' % ((xcoord,ycoord))))
 
+    @timed('goal')
     def set_goal_shape(self, shape, default_offset=None, obstacle_inflation=0):
-        goal_points = []
         if shape.obstacle_id.startswith('Room'):
-            empty_points, goal_points = self.generate_room_goal_points(shape, default_offset)
-        else:   # cubes, charger, markers
-            empty_points, goal_points = self.generate_cube_goal_points(shape, obstacle_inflation)
+            self.set_room_goal(shape, default_offset)
+            return
+        # cubes, charger, markers
+        empty_points, goal_points = self.generate_cube_goal_points(shape, obstacle_inflation)
         for point in empty_points:
             self.set_empty_cell(*rotate_point(point, shape.center[0:2,0], shape.orient))
         for point in goal_points:
             self.set_goal_cell(*rotate_point(point, shape.center[0:2,0], shape.orient))
 
-    def generate_room_goal_points(self, shape, default_offset):
+    def set_goal_shapes(self, shapes, default_offset=None, obstacle_inflation=0):
+        """Mark several goal shapes at once.  self.goal_labels records the
+        index of the shape each goal cell belongs to, or -1."""
+        self.goal_labels = np.full(self.grid_shape, -1, dtype=np.int16)
+        for (i, shape) in enumerate(shapes):
+            before = self.grid == self.goal_marker
+            self.set_goal_shape(shape, default_offset, obstacle_inflation)
+            self.goal_labels[(self.grid == self.goal_marker) & ~before] = i
+
+    def set_room_goal(self, shape, default_offset):
+        """Mark the room's goal cells with one array write.  See
+        geometry.polygon_mask for the meaning of the offset."""
         offset = -1 if default_offset is None else default_offset
-        if offset > 0:
-            isConcave, vertices_lst = check_concave(shape)
-        else:
-            isConcave, vertices_lst = False, []
-        if isConcave:
-            for vertices in vertices_lst:
-                goal_points += polygon_fill(Polygon(vertices), offset)
-        else:
-            goal_points = polygon_fill(shape, offset)
-        empty_points = []
-        return (empty_points, goal_points)
+        ((xmin,ymin), (xmax,ymax)) = shape.get_bounding_box()
+        (slices, gx, gy) = self.cell_centers(xmin, ymin, xmax, ymax)
+        mask = polygon_mask(gx, gy, shape.vertices, offset, pad=self.square_size/2)
+        self.grid[slices][mask] = self.goal_marker
 
     def generate_cube_goal_points(self,shape,obstacle_inflation):
         # for cubes, charger, markers
@@ -145,17 +313,312 @@ class WaveFront():
     def check_start_collides(self,xstart,ystart):
         (x,y) = self.coords_to_grid(xstart,ystart)
         contents = self.grid[x,y]
-        if contents == 0 or contents == self.goal_marker:
+        if contents == 0 or contents == self.goal_marker or contents == self.outside_marker:
             return False
         else:
             collider = self.obstacles[contents]
             print('start collides:', (xstart,ystart), (x,y), collider)
             return collider
 
+    @timed('raster')
+    def restrict_to_corridor(self, path_coords, half_width):
+        """Mark every empty cell farther than about half_width mm from the
+        cells of path_coords as outside, so propagate() won't enter it."""
+        mask = np.zeros(self.grid_shape, dtype=bool)
+        for (xcoord,ycoord) in path_coords:
+            (x,y) = self.coords_to_grid(xcoord,ycoord)
+            if x is not None:
+                mask[x,y] = True
+        mask = dilate_mask(mask, ceil(half_width / self.square_size))
+        self.grid[~mask & (self.grid == 0)] = self.outside_marker
+
+    def restrict_to_region(self, polygons, margin):
+        """Mark every empty cell more than margin mm outside all of the
+        polygons (e.g., rooms) as outside, so searches stay within them."""
+        (W,H) = self.grid_shape
+        xs = self.bbox[0][0] - 2*self.inflate_size + self.square_size * np.arange(W)
+        ys = self.bbox[0][1] - 2*self.inflate_size + self.square_size * np.arange(H)
+        (gx, gy) = np.meshgrid(xs, ys, indexing='ij')
+        inside = np.zeros(self.grid_shape, dtype=bool)
+        for vertices in polygons:
+            inside |= points_in_polygon(gx, gy, vertices)
+            inside |= polygon_edge_distance(gx, gy, vertices) <= margin
+        self.grid[~inside & (self.grid == 0)] = self.outside_marker
+        self.region = polygons
+
+    border_marker = np.iinfo(np.int32).min
+
+    def goal_accessible(self):
+        """False if no goal cell has an empty neighbor, e.g., when the goal
+        lies wholly inside an inflated obstacle.  Searches check this
+        first, since otherwise they would fill every reachable cell
+        before giving up."""
+        goals = self.grid == self.goal_marker
+        return bool((dilate_mask(goals, 1) & (self.grid == 0)).any())
+
+    @timed('propagate', counts_cells=True)
     def propagate(self,xstart,ystart):
         """
         Propagate the wavefront in eight directions from the starting coordinates
-        until a goal cell is reached or we fill up the grid.
+        until a goal cell is reached or we fill up the grid.  This is Dial's
+        algorithm: since steps cost 10 or 14, cells are kept in buckets by
+        distance, and a whole bucket is expanded at once with array operations
+        on the flattened grid.  The grid is padded with a border so neighbor
+        indices never need bounds checks.  Results are the same as
+        propagate_heap() and are compatible with extract().
+        """
+        if self.check_start_collides(xstart,ystart):
+            raise StartCollides()
+
+        (x,y) = self.coords_to_grid(xstart,ystart)
+        goal_marker = self.goal_marker
+        if self.grid[x,y] == goal_marker:
+            return (x,y)
+        if not self.goal_accessible():
+            return None
+        (W,H) = self.grid_shape
+        stride = H + 2
+        padded = np.full((W+2, H+2), self.border_marker, dtype=np.int32)
+        padded[1:-1, 1:-1] = self.grid
+        flat = padded.ravel()
+        found = self.dial_expand(flat, stride, np.array([(x+1)*stride + (y+1)]), goal_marker)
+        self.grid[:,:] = padded[1:-1, 1:-1]
+        if found is None:
+            return None
+        return (found // stride - 1, found % stride - 1)
+
+    def check_cancel(self):
+        if self.cancel_token is not None and self.cancel_token.expired():
+            raise PlanningAborted()
+
+    def dial_expand(self, flat, stride, seeds, stop_marker=None):
+        """Bucket-queue expansion shared by propagate() and
+        propagate_field().  Seeds get distance 1; returns the flat index
+        of the first cell containing stop_marker that is reached, or None.
+        Raises PlanningAborted if the cancel token expires."""
+        steps = ((10, np.array([-stride, stride, -1, 1])),
+                 (14, np.array([-stride-1, -stride+1, stride-1, stride+1])))
+        buckets = {1: [seeds]}
+        pending = [1]
+        found = None
+        self.cells_expanded = 0
+        while pending and found is None:
+            self.check_cancel()
+            dist = heapq.heappop(pending)
+            cells = np.unique(np.concatenate(buckets.pop(dist)))
+            cells = cells[flat[cells] == 0]
+            if cells.size == 0:
+                continue
+            flat[cells] = dist
+            self.cells_expanded += cells.size
+            self.maxdist = dist + 14
+            for (cost, offsets) in steps:
+                neighbors = (cells[:,None] + offsets).ravel()
+                contents = flat[neighbors]
+                if stop_marker is not None:
+                    goals = neighbors[contents == stop_marker]
+                    if goals.size > 0:
+                        found = int(goals[0])
+                        break
+                neighbors = neighbors[contents == 0]
+                if neighbors.size > 0:
+                    newdist = dist + cost
+                    if newdist not in buckets:
+                        buckets[newdist] = []
+                        heapq.heappush(pending, newdist)
+                    buckets[newdist].append(neighbors)
+        return found
+
+    @timed('propagate', counts_cells=True)
+    def propagate_field(self):
+        """
+        Fill the whole grid with distances to the goal, seeding the
+        wavefront at every goal cell instead of at the start.  Goal cells
+        end up with distance 1.  The finished field can be reused by
+        descend() to plan from any number of start positions.  Returns
+        the number of goal cells, or 0 if there were none.
+        """
+        (W,H) = self.grid_shape
+        stride = H + 2
+        padded = np.full((W+2, H+2), self.border_marker, dtype=np.int32)
+        padded[1:-1, 1:-1] = self.grid
+        flat = padded.ravel()
+        seeds = np.flatnonzero(flat == self.goal_marker)
+        if seeds.size == 0:
+            return 0
+        flat[seeds] = 0
+        self.dial_expand(flat, stride, seeds)
+        self.grid[:,:] = padded[1:-1, 1:-1]
+        return seeds.size
+
+    @timed('extract')
+    def descend(self, xstart, ystart):
+        """
+        Follow a field built by propagate_field() downhill from the start
+        coordinates to the goal.  Returns the path in world coordinates,
+        start first like extract(), or None if the goal can't be reached.
+        """
+        (x,y) = self.coords_to_grid(xstart,ystart)
+        if x is None:
+            return None
+        grid = self.grid
+        dist = grid[x,y]
+        if dist < 0:
+            collider = self.obstacles.get(dist, None)
+            print('start collides:', (xstart,ystart), (x,y), collider)
+            raise StartCollides()
+        if dist == 0:
+            return None
+        xmax = self.grid_shape[0] - 1
+        ymax = self.grid_shape[1] - 1
+        path = [(x,y)]
+        while dist > 1:
+            (bestx, besty) = (x, y)
+            for (nx,ny) in ((x-1,y), (x+1,y), (x,y-1), (x,y+1),
+                            (x-1,y-1), (x-1,y+1), (x+1,y-1), (x+1,y+1)):
+                if 0 <= nx <= xmax and 0 <= ny <= ymax and 0 < grid[nx,ny] < dist:
+                    dist = grid[nx,ny]
+                    (bestx, besty) = (nx, ny)
+            (x,y) = (bestx, besty)
+            path.append((x,y))
+        return [self.grid_to_coords(x,y) for (x,y) in path]
+
+    @timed('propagate', counts_cells=True)
+    def propagate_goals(self, xstart, ystart):
+        """
+        Propagate from the start over the whole grid, then find how
+        cheaply each goal marked by set_goal_shapes() can be entered.
+        Returns a list of (goal_index, cost_mm, goal_cell) sorted by
+        cost, containing only the reachable goals.  Pass goal_cell to
+        extract() to get the path to that goal.
+        """
+        if self.check_start_collides(xstart,ystart):
+            raise StartCollides()
+
+        (x,y) = self.coords_to_grid(xstart,ystart)
+        goal_marker = self.goal_marker
+        labels = self.goal_labels
+        start_label = labels[x,y] if self.grid[x,y] == goal_marker else -1
+        self.grid[x,y] = 0
+        (W,H) = self.grid_shape
+        stride = H + 2
+        padded = np.full((W+2, H+2), self.border_marker, dtype=np.int32)
+        padded[1:-1, 1:-1] = self.grid
+        self.dial_expand(padded.ravel(), stride, np.array([(x+1)*stride + (y+1)]))
+        self.grid[:,:] = padded[1:-1, 1:-1]
+        # Cheapest entry into each cell from a reached neighbor.
+        unreached = np.iinfo(np.int64).max // 2
+        dists = np.where((padded > 0) & (padded != goal_marker), padded.astype(np.int64), unreached)
+        reach = np.full((W,H), unreached, dtype=np.int64)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                if dx == 0 and dy == 0: continue
+                cost = 14 if dx and dy else 10
+                neighbor = dists[1+dx:W+1+dx, 1+dy:H+1+dy]
+                np.minimum(reach, neighbor + cost, out=reach)
+        results = []
+        for i in range(labels.max() + 1):
+            if i == start_label:
+                results.append((i, 0, (x,y)))
+                continue
+            cells = np.flatnonzero(((labels == i) & (self.grid == goal_marker)).ravel())
+            if cells.size == 0:
+                continue
+            best = cells[np.argmin(reach.ravel()[cells])]
+            dist = reach.ravel()[best]
+            if dist >= unreached:
+                continue
+            cost = float(dist - 1) * self.square_size / 10
+            results.append((i, cost, (int(best // H), int(best % H))))
+        results.sort(key=lambda entry: entry[1])
+        return results
+
+    @timed('astar', counts_cells=True)
+    def astar(self, xstart, ystart):
+        """
+        A* search from the starting coordinates to the nearest goal cell,
+        using the octile distance to the goal cells' bounding box as the
+        heuristic.  Expanded cells get their path cost in the same units
+        as propagate(), so extract() works on the result.  Returns the
+        goal cell reached, or None.
+        """
+        if self.check_start_collides(xstart,ystart):
+            raise StartCollides()
+
+        (x,y) = self.coords_to_grid(xstart,ystart)
+        goal_marker = self.goal_marker
+        if self.grid[x,y] == goal_marker:
+            return (x,y)
+        goals = np.argwhere(self.grid == goal_marker)
+        if goals.size == 0 or not self.goal_accessible():
+            return None
+        (gx0, gy0) = goals.min(0) + 1  # padded coordinates
+        (gx1, gy1) = goals.max(0) + 1
+        (W,H) = self.grid_shape
+        stride = H + 2
+        padded = np.full((W+2, H+2), self.border_marker, dtype=np.int32)
+        padded[1:-1, 1:-1] = self.grid
+        flat = padded.ravel()
+        def octile(cells):
+            "Heuristic for flat cell indices, computed only for the cells reached."
+            (cx, cy) = np.divmod(cells, stride)
+            dx = np.maximum(np.maximum(gx0 - cx, cx - gx1), 0)
+            dy = np.maximum(np.maximum(gy0 - cy, cy - gy1), 0)
+            return 10*np.maximum(dx,dy) + 4*np.minimum(dx,dy)
+        offsets = np.array([-stride, stride, -1, 1, -stride-1, -stride+1, stride-1, stride+1])
+        step_costs = np.array([10, 10, 10, 10, 14, 14, 14, 14])
+        # Like dial_expand(), but the buckets are keyed by g+h.  With a
+        # consistent heuristic every entry in a bucket has its final cost,
+        # so a whole bucket can be expanded at once.
+        start = (x+1)*stride + (y+1)
+        f = int(octile(start)) + 1
+        buckets = {f: [(np.array([start]), np.array([1]))]}
+        pending = [f]
+        found = None
+        self.cells_expanded = 0
+        while pending and found is None:
+            self.check_cancel()
+            f = heapq.heappop(pending)
+            while buckets.get(f) and found is None:
+                entries = buckets.pop(f)
+                cells = np.concatenate([c for (c,g) in entries])
+                costs = np.concatenate([g for (c,g) in entries])
+                (cells, first) = np.unique(cells, return_index=True)
+                costs = costs[first]
+                keep = flat[cells] == 0
+                (cells, costs) = (cells[keep], costs[keep])
+                if cells.size == 0:
+                    continue
+                flat[cells] = costs
+                self.cells_expanded += cells.size
+                neighbors = (cells[:,None] + offsets).ravel()
+                contents = flat[neighbors]
+                goals = np.flatnonzero(contents == goal_marker)
+                if goals.size > 0:
+                    found = int(neighbors[goals[0]])
+                    break
+                open_cells = contents == 0
+                neighbors = neighbors[open_cells]
+                newg = (costs[:,None] + step_costs).ravel()[open_cells]
+                newf = newg + octile(neighbors)
+                order = np.argsort(newf, kind='stable')
+                (values, starts) = np.unique(newf[order], return_index=True)
+                ends = np.append(starts[1:], order.size)
+                for (value, i, j) in zip(values.tolist(), starts.tolist(), ends.tolist()):
+                    if value not in buckets:
+                        buckets[value] = []
+                        if value != f:
+                            heapq.heappush(pending, value)
+                    buckets[value].append((neighbors[order[i:j]], newg[order[i:j]]))
+        self.grid[:,:] = padded[1:-1, 1:-1]
+        if found is None:
+            return None
+        return (found // stride - 1, found % stride - 1)
+
+    def propagate_heap(self,xstart,ystart):
+        """
+        The original one-cell-at-a-time version of propagate(), using a
+        priority queue.  Kept for reference and benchmarking.
         """
         if self.check_start_collides(xstart,ystart):
             raise StartCollides()
@@ -220,6 +683,7 @@ class WaveFront():
                     heapq.heappush(fringe, (dist10,(x,y+1)))
         return None
 
+    @timed('extract')
     def extract(self, search_result, wf_start):
         "Extract the path once the goal is found, and convert back to worldmap coordinates."
         start_coords = self.coords_to_grid(*wf_start)
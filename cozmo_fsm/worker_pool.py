@@ -0,0 +1,183 @@
+"""
+Pool of long-lived worker processes for LaunchProcess nodes.
+
+Launching a fresh Process for every job means paying for process
+startup and pickling the job into it each time.  The pool's workers are
+started once, by StateMachineProgram, and wait on a job queue.  A job
+names a static workhorse function, the job id the event router gave
+the node that submitted it, and the workhorse's arguments.  Workers post results through the
+event router's interprocess queue, exactly as a one-shot process would.
+Large arrays can be sent back as SharedArray handles instead, and a
+CancelToken lets the parent stop a job that is no longer wanted.
+"""
+
+import os
+import time
+import traceback
+import numpy as np
+from multiprocessing import Process, Queue, resource_tracker, shared_memory
+
+from .events import FailureEvent
+
+def worker_loop(job_queue, reply_queue):
+    "Main loop of a worker process; a None job tells it to exit."
+    while True:
+        job = job_queue.get()
+        if job is None:
+            return
+        (workhorse, job_id, args) = job
+        reply_token = (job_id, reply_queue)
+        try:
+            workhorse(reply_token, *args)
+        except Exception as e:
+            traceback.print_exc()
+            reply_queue.put((job_id, FailureEvent(repr(e))))
+
+
+class WorkerPool():
+    def __init__(self, num_workers=2):
+        self.num_workers = num_workers
+        self.workers = []
+        self.job_queue = None
+        self.reply_queue = None
+
+    def __repr__(self):
+        alive = sum(1 for p in self.workers if p.is_alive())
+        return '<WorkerPool: %d of %d workers alive>' % (alive, self.num_workers)
+
+    def is_running(self, reply_queue):
+        return self.reply_queue is reply_queue and len(self.workers) > 0 and \
+               all(p.is_alive() for p in self.workers)
+
+    def start(self, reply_queue):
+        """Start the workers, replacing any that are running.  Results go to
+        reply_queue, which must be the event router's interprocess_queue.
+        Queues can only be passed to a process when it is created, so the
+        pool has to be restarted whenever the router replaces its queue."""
+        self.shutdown()
+        # Start this process's resource tracker before forking, so the
+        # workers share it instead of each starting their own; see
+        # CancelToken.cancelled.
+        resource_tracker.ensure_running()
+        self.reply_queue = reply_queue
+        self.job_queue = Queue()
+        for i in range(self.num_workers):
+            p = Process(target=worker_loop, args=(self.job_queue, reply_queue),
+                        daemon=True, name='Worker-%d' % i)
+            p.start()
+            self.workers.append(p)
+
+    def ensure_running(self, reply_queue):
+        if not self.is_running(reply_queue):
+            self.start(reply_queue)
+
+    def submit(self, workhorse, job_id, args, reply_queue):
+        """Queue a call of workhorse((job_id, reply_queue), *args) on the
+        next free worker.  workhorse must be picklable, e.g., a static
+        method of a LaunchProcess subclass."""
+        self.ensure_running(reply_queue)
+        self.job_queue.put((workhorse, job_id, args))
+
+    def shutdown(self, timeout=1):
+        if self.job_queue is None:
+            return
+        for p in self.workers:
+            self.job_queue.put(None)
+        for p in self.workers:
+            p.join(timeout)
+            if p.is_alive():
+                p.terminate()
+        self.job_queue.close()
+        self.workers = []
+        self.job_queue = None
+        self.reply_queue = None
+
+
+class SharedArray():
+    """Handle for a copy of a numpy array placed in shared memory.  The
+    handle pickles to a few bytes, so a worker can send back a large
+    array without pushing it through the reply queue.  The receiving
+    process calls fetch() once to get the array and free the buffer; a
+    handle that is dropped unfetched frees the buffer when collected."""
+    def __init__(self, array):
+        shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+        self.name = shm.name
+        self.shape = array.shape
+        self.dtype = array.dtype.str
+        self.creator_pid = os.getpid()
+        self.released = False
+        # The receiver owns the buffer, so don't let this process's
+        # resource tracker unlink it when the worker exits.
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        shm.close()
+
+    def __repr__(self):
+        return '<SharedArray %s %s %s>' % (self.name, self.dtype, self.shape)
+
+    def fetch(self):
+        shm = shared_memory.SharedMemory(name=self.name)
+        array = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf).copy()
+        shm.close()
+        shm.unlink()
+        self.released = True
+        return array
+
+    def __del__(self):
+        if not self.released and os.getpid() != self.creator_pid:
+            try:
+                self.fetch()
+            except Exception:
+                pass
+
+
+class CancelToken():
+    """Lets a parent process cancel a job running in a worker, and gives
+    the job an optional deadline (a time.time() value).  The flag lives
+    in a one-byte shared memory buffer, so the token pickles to its name
+    and can travel with a job.  cancel() unlinks the buffer; a worker
+    that can no longer find it treats the job as cancelled."""
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.shm = shared_memory.SharedMemory(create=True, size=1)
+        self.shm.buf[0] = 0
+        self.name = self.shm.name
+        self.creator_pid = os.getpid()
+
+    def __repr__(self):
+        return '<CancelToken %s%s>' % (self.name, ' cancelled' if self.cancelled() else '')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shm'] = None
+        return state
+
+    def cancel(self):
+        "Called by the creator to cancel the job, or to free the token once the job is done."
+        if self.shm is not None and os.getpid() == self.creator_pid:
+            self.shm.buf[0] = 1
+            self.shm.close()
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:  # already removed, e.g., by a killed worker's tracker
+                pass
+        self.shm = None
+
+    def cancelled(self):
+        if self.shm is None:
+            if os.getpid() == self.creator_pid:
+                return True
+            try:
+                self.shm = shared_memory.SharedMemory(name=self.name)
+            except FileNotFoundError:
+                return True
+            # Attaching registers the name with the resource tracker.
+            # WorkerPool.start makes sure the workers share the
+            # creator's tracker, where the name is already registered,
+            # so the creator's unlink settles it.
+        return self.shm.buf[0] != 0
+
+    def expired(self):
+        "True if the job has been cancelled or its deadline has passed."
+        return (self.deadline is not None and time.time() > self.deadline) or \
+               self.cancelled()
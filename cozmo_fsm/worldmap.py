@@ -477,15 +477,26 @@ class LightCubeForeignObj(WorldObject):
 
 class WorldMap():
     vision_z_fudge = 10  # Cozmo underestimates object z coord by about this much
+    # Pose changes smaller than these don't count as changes to the map,
+    # so sensor jitter doesn't invalidate the planners' caches.
+    signature_xy_tolerance = 5  # mm
+    signature_theta_tolerance = 2 / 180 * pi
 
     def __init__(self,robot):
         self.robot = robot
         self.objects = dict()
         self.shared_objects = dict()
+        # version is bumped whenever an object's pose or shape changes,
+        # so path planner caches can tell when the map is stale.
+        self.version = 0
+        self.object_signatures = dict()
+        self.room_graph = None  # see topology.get_room_graph
 
     def clear(self):
         self.objects.clear()
         self.robot.world.particle_filter.clear_landmarks()
+        self.object_signatures.clear()
+        self.version += 1
 
     def add_fixed_landmark(self,landmark):
         landmark.is_fixed = True
@@ -517,6 +528,7 @@ class WorldMap():
         for door_id in door_ids:
             if door_id in self.objects:
                 del self.objects[door_id]
+        self.update_version()
 
     def update_map(self):
         """Called to update the map after every camera image, after
@@ -537,6 +549,43 @@ class WorldMap():
         self.update_doorways()
         self.update_rooms()
         self.update_perched_cameras()
+        self.update_version()
+
+    @staticmethod
+    def object_signature(obj):
+        """Everything about an object that affects the obstacles generated
+        from it: its pose, then the rest."""
+        theta = getattr(obj, 'theta', 0)
+        return (obj.x, obj.y, theta, type(obj).__name__,
+                obj.is_obstacle, obj.pose_confidence >= 0,
+                getattr(obj, 'size', None), getattr(obj, 'length', None),
+                getattr(obj, 'radius', None), getattr(obj, 'spec_id', None))
+
+    def same_signature(self, old, new):
+        "True if new differs from old by no more than the pose tolerances."
+        if old is None or new is None or old[3:] != new[3:]:
+            return old == new
+        return abs(new[0] - old[0]) <= self.signature_xy_tolerance and \
+               abs(new[1] - old[1]) <= self.signature_xy_tolerance and \
+               abs(wrap_angle(new[2] - old[2])) <= self.signature_theta_tolerance
+
+    def update_version(self):
+        """Recompute object signatures and bump the map version if anything
+        changed.  An object that has moved by less than the tolerances
+        keeps its old signature, so small changes can't add up unnoticed
+        and jitter around a rounding boundary doesn't register."""
+        signatures = dict()
+        for (key,obj) in self.objects.items():
+            try:
+                signature = self.object_signature(obj)
+            except AttributeError:  # incompletely initialized object
+                signature = None
+            old = self.object_signatures.get(key)
+            signatures[key] = old if self.same_signature(old, signature) else signature
+        if signatures != self.object_signatures:
+            self.object_signatures = signatures
+            self.version += 1
+        return self.version
 
     def update_cube(self, cube):
         cube_id = 'Cube-' + str(cube.cube_id)